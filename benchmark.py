@@ -0,0 +1,425 @@
+from pyPWMd import pypwm_client, pypwm_cluster, socket, bpack, bunpack
+from pyPWMd import pypwm_server, sysfs, simulator, chardev
+from pyPWMd import _pwmwf, _pwmrequest, _pwmfree, _pwmgetwf, _pwmsetwf
+from time import perf_counter, sleep, strftime
+from pickle import dumps, loads
+from sys import exit, argv, executable, version as pyversion
+from os import path, makedirs, mkfifo, rename
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from contextlib import redirect_stdout
+from errno import EBUSY, EINVAL
+from io import StringIO
+from multiprocessing import Process, Queue, Barrier
+from subprocess import Popen, DEVNULL, run
+from py_compile import compile as pycompile
+import json
+
+'''
+    Python PWM benchmark script
+
+    see: https://github.com/easytarget/pyPWMd
+
+    Usage: python3 benchmark.py [<test>] [<count>] [--option=value ...]
+    where <test> is one of:
+      latency  (default) client -> server round trip times, needs a
+               pypwm_server() running on the default socket.
+      codec    request encode/decode cost for the text and binary protocols.
+      suite    runs a private server against a simulated /sys/class/pwm tree
+               in a temporary directory and measures the 'pwm', 'servo',
+               'states' and 'open'/'close' commands with 1..N clients and
+               small and large numbers of pwm chips. No hardware is needed.
+      cluster  runs several private servers (as for 'suite', --nodes=<n>,
+               default 4) and compares sequential per-node clients with the
+               pypwm_cluster fan-out for batches and states, then stops one
+               server to show partial failure reporting.
+      backends runs the server commands in process (no socket) with each of
+               the output backends; sysfs on a simulated tree, the in-memory
+               simulator, and chardev with simulated ioctls, which are checked
+               by reading the timers back.
+      realtime compares the server's command latency and scheduler jitter
+               with and without the realtime mode (needs root), while it
+               runs fades on --timers timers, optionally with --load=<n>
+               busy processes competing for the cpus.
+      startup  commandline client start times, running 'help' with pyPWMd.py
+               and the pwmtimerctl.py launcher (20 runs by default).
+
+    <count> is the number of commands per test and client (default 1000)
+
+    Options:
+      --clients=<n,n..>    suite: concurrent client counts (default 1,2,4)
+      --chips=<n,n..>      suite: simulated chip counts (default 1,16)
+      --timers=<n>         suite, cluster, backends, realtime: timers per chip (default 4)
+      --nodes=<n>          cluster: number of servers (default 4)
+      --output=<file>      suite: write results as json, for comparing runs
+      --load=<n>           realtime: busy processes to run (default 0)
+      --priority=<n>       realtime: SCHED_FIFO priority (default 50)
+
+    The 'pwmfreq' query is used for latency timing since it is answered by
+    the server without touching the /sys/class/pwm tree.
+'''
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p))]
+
+def latency(client, count):
+    # Returns a sorted list of round trip times in seconds
+    times = []
+    for _ in range(count):
+        start = perf_counter()
+        client.pwmfreq()
+        times.append(perf_counter() - start)
+    return sorted(times)
+
+def report(title, times):
+    print('{:<16} mean: {:8.1f}us  p50: {:8.1f}us  p99: {:8.1f}us  ({:.0f} cmds/s)'
+        .format(title, sum(times) / len(times) * 1e6, percentile(times, 0.5) * 1e6,
+            percentile(times, 0.99) * 1e6, len(times) / sum(times)))
+
+def timed(fn, count):
+    # Returns a sorted list of call times in seconds
+    times = []
+    for _ in range(count):
+        start = perf_counter()
+        fn()
+        times.append(perf_counter() - start)
+    return sorted(times)
+
+def textparse(message):
+    # what the server does with a text 'pwm' request; split, then type the arguments
+    cmdline = loads(message).strip().split(' ')
+    return cmdline[0], [int(float(cmdline[1])), int(float(cmdline[2])), float(cmdline[3])]
+
+def codec(count):
+    # The request side mirrors what client and server do for a 'pwm' command,
+    # replies (pickled for both protocols) are a simple result and a 'states' map.
+    states = {str(c): {t: (1, 1000000, 500000 + t, 'normal') if t % 2 else None
+        for t in range(8)} for c in range(2)}
+    text = dumps('pwm {} {} {}'.format(0, 1, 0.5))
+    binary = bpack('pwm', [0, 1, 0.5])
+    print('Message encode/decode cost, {} messages:'.format(count))
+    report('text request', timed(lambda: dumps('pwm {} {} {}'.format(0, 1, 0.5)), count))
+    report('text parse', timed(lambda: textparse(text), count))
+    report('bin request', timed(lambda: bpack('pwm', (0, 1, 0.5)), count))
+    report('bin parse', timed(lambda: bunpack(binary), count))
+    print('{:<16} size: text {} bytes, binary {} bytes'.format('', len(text), len(binary)))
+    # replies are pickled by both protocols
+    for title, reply in (('result', True), ('states', states)):
+        report('reply {}'.format(title), timed(lambda: loads(dumps(reply)), count))
+        print('{:<16} size: {} bytes'.format('', len(dumps(reply))))
+
+class faketree:
+    '''
+        A simulated /sys/class/pwm tree in a temporary directory.
+        'export' and 'unexport' are fifos, a thread per chip reads them and
+        creates or removes the timer nodes like the kernel does.
+    '''
+
+    def __init__(self, chips, timers):
+        self.base = mkdtemp(prefix='pyPWMd-bench-')
+        self.sysbase = self.base + '/pwm'
+        self.sock = self.base + '/pyPWMd.socket'
+        for chip in range(chips):
+            node = '{}/pwmchip{}'.format(self.sysbase, chip)
+            makedirs(node)
+            with open(node + '/npwm', 'w') as npwm:
+                npwm.write('{}\n'.format(timers))
+            for fifo in ('export', 'unexport'):
+                mkfifo(node + '/' + fifo)
+                Thread(target=self._serve, args=(node, fifo), daemon=True).start()
+
+    def _serve(self, node, fifo):
+        while True:
+            with open(node + '/' + fifo) as f:
+                request = f.read().strip()
+            if not request.isdigit():
+                continue
+            timer = '{}/pwm{}'.format(node, request)
+            if fifo == 'unexport':
+                rmtree(timer, ignore_errors=True)
+            elif not path.exists(timer):
+                makedirs(timer + '.new')
+                for prop, value in (('enable', 0), ('period', 0), ('duty_cycle', 0),
+                        ('polarity', 'normal')):
+                    with open('{}.new/{}'.format(timer, prop), 'w') as f:
+                        f.write('{}\n'.format(value))
+                rename(timer + '.new', timer)
+
+    def remove(self):
+        rmtree(self.base, ignore_errors=True)
+
+class fakepwm:
+    '''
+        Simulated pwm character device ioctls, for the chardev backend.
+        Waveforms are kept per device fd and timer, calls are counted.
+    '''
+
+    def __init__(self):
+        self.waveforms = {}  # (fd, timer): (period, duty, offset)
+        self.requested = set()
+        self.calls = 0
+
+    def ioctl(self, fd, request, arg=0, mutate=False):
+        self.calls += 1
+        if request == _pwmrequest:
+            if (fd, arg) in self.requested:
+                raise OSError(EBUSY, 'timer busy')
+            self.requested.add((fd, arg))
+        elif request == _pwmfree:
+            self.requested.discard((fd, arg))
+        elif request == _pwmgetwf:
+            timer = _pwmwf.unpack(arg)[0]
+            arg[:] = _pwmwf.pack(timer, 0, *self.waveforms.get((fd, timer), (0, 0, 0)))
+        elif request == _pwmsetwf:
+            timer, _, period, duty, offset = _pwmwf.unpack(arg)
+            if (fd, timer) not in self.requested or duty > period:
+                raise OSError(EINVAL, 'invalid waveform')
+            self.waveforms[(fd, timer)] = (period, duty, offset)
+        else:
+            raise OSError(EINVAL, 'unknown ioctl')
+
+def server(tree, **config):
+    # Runs a private server process on the fake tree, returns the process
+    code = ('import sys; sys.path.insert(0, {!r}); import pyPWMd; '
+        'pyPWMd.pypwm_server(sock={!r}, sysbase={!r}, **{!r}).server()').format(
+        path.dirname(path.abspath(__file__)), tree.sock, tree.sysbase, config)
+    proc = Popen([executable, '-c', code], stdout=DEVNULL, stderr=DEVNULL)
+    for _ in range(500):
+        if path.exists(tree.sock):
+            break
+        sleep(0.01)
+    return proc
+
+def worker(sock, test, chip, timer, count, barrier, results):
+    # One benchmark client process, puts its list of command times on the queue
+    client = pypwm_client(sock=sock, session=True)
+    if test in ('pwm', 'servo'):
+        client.open(chip, timer)
+    commands = {
+        'pwm': lambda i: client.pwm(chip, timer, (i % 100) / 100),
+        'servo': lambda i: client.servo(chip, timer, (i % 100) / 100),
+        'states': lambda i: client.states(),
+        'open/close': lambda i: client.open(chip, timer) if i % 2 == 0 else client.close(chip, timer),
+    }
+    command = commands[test]
+    barrier.wait()
+    times = []
+    for i in range(count):
+        start = perf_counter()
+        command(i)
+        times.append(perf_counter() - start)
+    if test in ('pwm', 'servo'):
+        client.close(chip, timer)
+    client.disconnect()
+    results.put(times)
+
+def startup(count):
+    # pwmtimerctl.py imports the compiled module, make sure the cache exists
+    # (it is not written when running as a script, or with PYTHONDONTWRITEBYTECODE)
+    here = path.dirname(path.abspath(__file__))
+    pycompile(here + '/pyPWMd.py')
+    print('Commandline start times, {} runs:'.format(count))
+    for title, cmd in (('python3 -c pass', ['-c', 'pass']),
+            ('import pyPWMd', ['-c', 'import pyPWMd']),
+            ('pyPWMd.py', [here + '/pyPWMd.py', 'help']),
+            ('pwmtimerctl.py', [here + '/pwmtimerctl.py', 'help'])):
+        report(title, timed(lambda: run([executable] + cmd, cwd=here, stdout=DEVNULL), count))
+
+def cluster(nodes, timers, count):
+    trees = [faketree(1, timers) for _ in range(nodes)]
+    procs = [server(tree) for tree in trees]
+    try:
+        socks = {'node{}'.format(n): tree.sock for n, tree in enumerate(trees)}
+        clients = {node: pypwm_client(sock=sock, session=True) for node, sock in socks.items()}
+        pool = pypwm_cluster(socks)
+        for node in socks.keys():
+            for timer in range(timers):
+                pool.open(node, 0, timer)
+        print('Cluster of {} nodes, {} timers each, {} commands:'.format(nodes, timers, count))
+        def sequential():
+            for client in clients.values():
+                client.batch([('pwm', 0, t, 0.5) for t in range(timers)])
+        ops = [('pwm', node, 0, t, 0.5) for node in socks.keys() for t in range(timers)]
+        report('batch clients', timed(sequential, count))
+        report('batch cluster', timed(lambda: pool.batch(ops), count))
+        report('states clients', timed(lambda: [c.states() for c in clients.values()], count))
+        report('states cluster', timed(pool.states, count))
+        procs[-1].terminate()
+        procs[-1].wait()
+        states = pool.states()
+        print('With {} stopped, failed nodes: {}'.format(list(socks.keys())[-1], pool.failed(states)))
+        pool.disconnect()
+        for client in clients.values():
+            client.disconnect()
+    finally:
+        for proc, tree in zip(procs, trees):
+            proc.terminate()
+            proc.wait()
+            tree.remove()
+
+def backends(timers, count):
+    tree = faketree(1, timers)
+    devices = mkdtemp(prefix='pyPWMd-dev-')
+    open(devices + '/pwmchip0', 'w').close()
+    fake = fakepwm()
+    print('Output backends, in process, {} timers, {} commands:'.format(timers, count))
+    try:
+        for title, backend in (('sysfs', sysfs(tree.sysbase)), ('sim', simulator(1, timers)),
+                ('chardev', chardev(devices, tree.sysbase, fake.ioctl))):
+            with redirect_stdout(StringIO()):  # server log messages
+                pwm = pypwm_server(backend=backend)
+                for timer in range(timers):
+                    pwm._request('open 0 {}'.format(timer))
+                calls = fake.calls
+                # duty only changes, then alternating pwm/servo (period changes)
+                n = iter(range(2 * count))
+                def setduty(i):
+                    pwm._request('pwm 0 {} {}'.format(i % timers, (i % 97) / 100))
+                duty = timed(lambda: setduty(next(n)), count)
+                period = timed(lambda: pwm._request('{} 0 0 0.5'.format(
+                    ('pwm', 'servo')[next(n) % 2])), count)
+                states = pwm._states()
+                pwm._resync()
+                readback = pwm._states() == states
+                pwm.closelog()
+            report(title + ' duty', duty)
+            report(title + ' period', period)
+            if title == 'chardev':
+                print('{:<16} {:.2f} ioctls per command, read back {}'.format('',
+                    (fake.calls - calls) / (2 * count), 'ok' if readback else 'FAILED'))
+    finally:
+        tree.remove()
+        rmtree(devices, ignore_errors=True)
+
+def busy():
+    while True:
+        pass
+
+def realtime(timers, count, load, priority):
+    # Fades run by the server on all but one timer while a client sets the
+    # last one, the server's latency and jitter figures are compared
+    print('Realtime mode, {} timers fading, {} pwm commands, {} busy processes:'.format(
+        timers, count, load))
+    loads = [Process(target=busy, daemon=True) for _ in range(load)]
+    for proc in loads:
+        proc.start()
+    try:
+        for title, config in (('normal', {}), ('realtime', {'realtime': priority})):
+            tree = faketree(1, timers + 1)
+            proc = server(tree, **config)
+            try:
+                client = pypwm_client(sock=tree.sock, session=True)
+                for timer in range(timers + 1):
+                    client.open(0, timer)
+                for timer in range(timers):
+                    client.fade(0, timer, 0, 1, 60)
+                for i in range(count):
+                    client.pwm(0, timers, (i % 100) / 100)
+                    sleep(0.001)
+                stats = client.stats()
+                client.disconnect()
+            finally:
+                proc.terminate()
+                proc.wait()
+                tree.remove()
+            for metric in ('latency', 'jitter'):
+                h = stats[metric]
+                # p99 is the upper bound of the bucket holding it
+                total, p99 = 0, None
+                for bound, n in zip(list(stats['buckets']) + [None], h['hist']):
+                    total += n
+                    if p99 is None and total >= 0.99 * h['count']:
+                        p99 = bound
+                print('{:<16} mean: {:8.1f}us  p99: <{:>7}us  max: {:8.1f}us  ({} samples)'.format(
+                    '{} {}'.format(title, metric), h['sum'] / max(1, h['count']) * 1e6,
+                    '-' if p99 is None else '{:.0f}'.format(p99 * 1e6), h['max'] * 1e6, h['count']))
+            if config:
+                print('{:<16} {}'.format('', stats['realtime'] or 'not applied, see the server log'))
+    finally:
+        for proc in loads:
+            proc.terminate()
+
+def suite(clients, chiplist, timers, count, output):
+    print('Benchmark suite, {} commands per client, {} timers per chip:'.format(count, timers))
+    print('{:<11} {:>5} {:>7} {:>10} {:>9} {:>9}'.format(
+        'test', 'chips', 'clients', 'cmds/s', 'p50 us', 'p99 us'))
+    results = []
+    for chips in chiplist:
+        tree = faketree(chips, timers)
+        proc = server(tree)
+        try:
+            for test in ('pwm', 'servo', 'states', 'open/close'):
+                for n in clients:
+                    barrier = Barrier(n + 1)
+                    queue = Queue()
+                    # spread the clients over the available timers
+                    workers = [Process(target=worker, args=(tree.sock, test,
+                        i % chips, (i // chips) % timers, count, barrier, queue))
+                        for i in range(n)]
+                    for w in workers:
+                        w.start()
+                    barrier.wait()
+                    start = perf_counter()
+                    times = sorted(t for _ in workers for t in queue.get())
+                    elapsed = perf_counter() - start
+                    for w in workers:
+                        w.join()
+                    result = {'test': test, 'chips': chips, 'timers': timers, 'clients': n,
+                        'commands': len(times), 'cmds_per_sec': round(len(times) / elapsed, 1),
+                        'p50_us': round(percentile(times, 0.5) * 1e6, 1),
+                        'p99_us': round(percentile(times, 0.99) * 1e6, 1)}
+                    results.append(result)
+                    print('{test:<11} {chips:>5} {clients:>7} {cmds_per_sec:>10.0f} '
+                        '{p50_us:>9.1f} {p99_us:>9.1f}'.format(**result))
+        finally:
+            proc.terminate()
+            proc.wait()
+            tree.remove()
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'time': strftime('%Y-%m-%dT%H:%M:%S'), 'python': pyversion.split()[0],
+                'count': count, 'results': results}, f, indent=1)
+        print('Results written to: {}'.format(output))
+
+if __name__ == '__main__':
+    # Options are given as '--option=value'
+    options = {}
+    for arg in [a for a in argv[1:] if a.startswith('--')]:
+        argv.remove(arg)
+        option, _, value = arg[2:].partition('=')
+        options[option] = value
+    test = 'latency' if len(argv) < 2 else argv[1]
+    count = 1000 if len(argv) < 3 else int(argv[2])
+
+    if test == 'cluster':
+        cluster(int(options.get('nodes', 4)), int(options.get('timers', 4)),
+            100 if len(argv) < 3 else count)
+    elif test == 'backends':
+        backends(int(options.get('timers', 4)), count)
+    elif test == 'realtime':
+        realtime(int(options.get('timers', 4)), count, int(options.get('load', 0)),
+            int(options.get('priority', 50)))
+    elif test == 'startup':
+        startup(20 if len(argv) < 3 else count)
+    elif test == 'codec':
+        codec(count)
+    elif test == 'suite':
+        suite([int(n) for n in options.get('clients', '1,2,4').split(',')],
+            [int(n) for n in options.get('chips', '1,16').split(',')],
+            int(options.get('timers', 4)), count, options.get('output', None))
+    elif test == 'latency':
+        # Connection per command (default) and persistent session clients
+        oneshot = pypwm_client()
+        if oneshot.connected == False:
+            print('No PWM server at {}, exiting..'.format(socket))
+            exit(1)
+        print('Round trip latency, {} commands:'.format(count))
+        report('per-command', latency(oneshot, count))
+        for title, session in (('session', pypwm_client(session=True)),
+                ('session binary', pypwm_client(session=True, binary=True))):
+            report(title, latency(session, count))
+            session.disconnect()
+    else:
+        print('Unknown test \'{}\', use one of: latency, codec, suite, cluster, backends, realtime, startup'.format(test))
+        exit(2)
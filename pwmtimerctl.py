@@ -0,0 +1,14 @@
+#!/usr/bin/python3
+'''
+  PWM server commandline client
+
+  Runs the pyPWMd commandline from the compiled (cached) module, rather
+  than compiling all of pyPWMd.py each time it is run as a script. Link
+  this as /usr/local/bin/pwmtimerctl for fast starts in shell scripts.
+
+  see: https://github.com/easytarget/pyPWMd
+'''
+
+from pyPWMd import main
+
+main()
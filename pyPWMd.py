@@ -3,13 +3,26 @@
   PWM server daemon
 '''
 
-from time import ctime
-from sys import argv, exit
-from os import path, remove, makedirs, chown, chmod, getuid, getgid, getpid
-from glob import glob
-from re import findall
-from multiprocessing.connection import Listener, Client
+from time import time, ctime, perf_counter, sleep, strftime
+from math import ceil
+from sys import argv, exit, stdin, stdout
+from os import path, listdir, getgrouplist, remove, rename, replace, makedirs, chown, chmod, getuid, getgid, getpid, stat
+from os import open as osopen, close as osclose, pwrite, preadv, O_RDWR, O_RDONLY
+from os import sched_setscheduler, sched_setaffinity, sched_param, SCHED_FIFO, strerror
+from errno import EBADF, ENODEV, ENOENT, ESTALE
+from multiprocessing.connection import Listener, Client, Connection, deliver_challenge, answer_challenge
 from multiprocessing import AuthenticationError
+from socket import socket as sockobj, fromfd, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_RCVTIMEO, SO_SNDTIMEO, SO_PEERCRED
+from struct import pack, Struct, error as StructError
+from pickle import Unpickler, UnpicklingError
+from io import BytesIO
+from threading import Thread, Lock, Event, Semaphore, local, stack_size, get_ident
+from queue import Queue, Full
+from signal import signal, SIGHUP, SIGTERM
+from pwd import getpwnam, getpwuid
+from grp import getgrnam
+from itertools import count
+from array import array
 import atexit
 
 # Some housekeeping
@@ -21,23 +34,829 @@ _sockdir = '/run/pwm'
 socket = _sockdir + '/pyPWMd.socket'
 # By default use version string as socket auth token, prevents API fails.
 auth = bytes(version.encode('utf-8'))
+# Peer credentials (pid, uid, gid) of a unix socket connection
+_ucred = Struct('3i')
+
+class _unpickler(Unpickler):
+    # Requests are only strings, numbers, bytes and tuples of those; refusing
+    # all globals stops a client running code in the server via a pickle.
+    def find_class(self, module, name):
+        raise UnpicklingError('forbidden global {}.{}'.format(module, name))
+
+def _loads(data):
+    return _unpickler(BytesIO(data)).load()
 
 # pwm API specifies nanoseconds as the base period unit.
 basefreq = 1000000000
 
+# Binary protocol (optional, negotiated with the 'caps' command)
+# Requests: header (magic, version, opcode) + the arguments packed to the
+#   opcode's layout; H = chip or timer, d = ratio, frequency or time, I = pid.
+#   Trailing optional arguments are left out, the request length gives the
+#   argument count. Ratios stay float64 so duty cycles match the text protocol.
+# Replies are pickled as for the text protocol, it is faster and more compact
+#   for nested replies (eg. 'states') than any pure python encoding.
+_bmagic = 0xb1  # pickled (text protocol) messages always start with 0x80
+_bversion = 3
+_blayouts = (('info', 'I'), ('states', ''), ('open', 'HH'), ('close', 'HH'),
+             ('pwm', 'HHd'), ('pwmfreq', 'd'), ('servo', 'HHd'), ('servoset', 'ddd'),
+             ('disable', 'HH'), ('cachestats', ''), ('resync', 'HH'), ('rescan', ''),
+             ('stats', ''), ('coalesce', 'HHd'))
+opcodes = tuple(cmd for cmd, _ in _blayouts)
+_opnums = {cmd: op for op, cmd in enumerate(opcodes)}
+# per opcode, a Struct (header included) for each argument count
+_brequests = [[Struct('<BBB' + layout[:n]) for n in range(len(layout) + 1)]
+    for _, layout in _blayouts]
+_bsizes = [{s.size: s for s in structs} for structs in _brequests]
+_bconvert = [[int if t in 'HI' else float for t in layout] for _, layout in _blayouts]
+
+def bpack(cmd, args):
+    op = _opnums[cmd]
+    request = _brequests[op][len(args)]
+    try:
+        return request.pack(_bmagic, _bversion, op, *args)
+    except StructError:  # eg. numbers given as strings
+        return request.pack(_bmagic, _bversion, op,
+            *[convert(float(a)) for convert, a in zip(_bconvert[op], args)])
+
+def bunpack(data):
+    # returns (command, [arguments]), the arguments are ready typed
+    if data[1] != _bversion:
+        raise ValueError('unsupported protocol version {}'.format(data[1]))
+    op = data[2]
+    request = _bsizes[op].get(len(data))
+    if request is None:
+        raise ValueError('bad length {} for \'{}\''.format(len(data), opcodes[op]))
+    return opcodes[op], list(request.unpack(data)[3:])
+
+def _bootid():
+    # identifies the current boot, None if it cannot be read
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# errors that indicate an open sysfs property file is no longer valid
+_stale = (EBADF, ENODEV, ENOENT, ESTALE)
+
+# PWM character device ioctls (linux/pwm.h), a waveform is struct pwmchip_waveform:
+# timer, padding, period_length_ns, duty_length_ns, duty_offset_ns
+_pwmwf = Struct('=IIQQQ')
+_pwmrequest = 0x7501  # _IO(0x75, 1)
+_pwmfree = 0x7502  # _IO(0x75, 2)
+_pwmgetwf = 0xc0207504  # _IOWR(0x75, 4, struct pwmchip_waveform)
+_pwmsetwf = 0x40207505  # _IOW(0x75, 5, struct pwmchip_waveform), rounded to the hardware
+
+# Fade curves, precomputed lookup tables indexed by fade progress (0->_steps)
+# 'name': (progress table, output (gamma) table or None)
+_steps = 1024
+_linear = [i / _steps for i in range(_steps + 1)]
+_ease = [3 * p ** 2 - 2 * p ** 3 for p in _linear]  # smoothstep
+_gamma = [p ** 2.2 for p in _linear]  # perceived brightness -> pwm ratio
+curves = {'linear': (_linear, None), 'ease': (_ease, None), 'gamma': (_linear, _gamma)}
+
+# Servo motion profiles, position (0->1) at time t (0->1) through the move
+def _trapezoid(t, ramp=0.25):
+    # constant acceleration for the first and last quarter of the move
+    vmax = 1 / (1 - ramp)
+    if t < ramp:
+        return 0.5 * vmax / ramp * t * t
+    if t > 1 - ramp:
+        return 1 - 0.5 * vmax / ramp * (1 - t) * (1 - t)
+    return vmax * (t - ramp / 2)
+
+def _scurve(t):
+    # smootherstep, zero velocity and acceleration at both ends
+    return t * t * t * (t * (t * 6 - 15) + 10)
+
+profiles = {'trapezoid': _trapezoid, 'scurve': _scurve}
+
+# Metrics histogram bucket upper bounds (seconds), powers of two from 1us to
+# ~1s, the last bucket counts anything longer.
+buckets = tuple(2 ** n / 1000000 for n in range(21))
+
+def _failed(result):
+    return result is None or (type(result) == str and 'error' in result.lower())
+
+class cmdstats:
+    '''
+        Call and error counts and time histograms for a server command
+    '''
+    __slots__ = ('calls', 'errors', 'time', 'timesum', 'io', 'iosum')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.time = [0] * (len(buckets) + 1)  # processing time
+        self.timesum = 0.0
+        self.io = [0] * (len(buckets) + 1)  # sysfs I/O time
+        self.iosum = 0.0
+
+    def record(self, elapsed, io, error):
+        self.calls += 1
+        self.errors += error
+        # bucket n holds times up to 2**n microseconds
+        self.time[min(int(elapsed * 1000000).bit_length(), len(buckets))] += 1
+        self.timesum += elapsed
+        self.io[min(int(io * 1000000).bit_length(), len(buckets))] += 1
+        self.iosum += io
+
+    def get(self):
+        return {'calls': self.calls, 'errors': self.errors,
+            'time': list(self.time), 'timesum': self.timesum,
+            'io': list(self.io), 'iosum': self.iosum}
+
+class iotime(local):
+    '''
+        Per thread sysfs I/O time, reset for each command, when the command
+        started and the client uid (0 and None for other server threads)
+    '''
+    seconds = 0.0
+    start = 0.0
+    uid = None
+
+class histogram:
+    '''
+        Counts of times in the metrics buckets, with their sum and maximum
+    '''
+    __slots__ = ('count', 'total', 'max', 'hist')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0] * (len(buckets) + 1)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.hist[min(int(seconds * 1000000).bit_length(), len(buckets))] += 1
+
+    def get(self):
+        return {'count': self.count, 'sum': self.total, 'max': self.max, 'hist': list(self.hist)}
+
+class watcher:
+    '''
+        A 'watch' subscription, changed timer states are held (latest only)
+        until the client handler sends them
+    '''
+    __slots__ = ('chip', 'timer', 'pending', 'lock', 'wake')
+
+    def __init__(self, chip=None, timer=None):
+        self.chip = chip
+        self.timer = timer
+        self.pending = {}  # (chip, timer): state
+        self.lock = Lock()
+        self.wake = Event()
+
+    def matches(self, chip, timer):
+        return (self.chip is None or self.chip == chip) and (
+            self.timer is None or self.timer == timer)
+
+class timerstate:
+    '''
+        Shadow copy of a timer's sysfs properties, kept by the server
+    '''
+    __slots__ = ('enable', 'period', 'duty', 'polarity')
+
+    def __init__(self, enable, period, duty, polarity):
+        self.enable = enable
+        self.period = period
+        self.duty = duty
+        self.polarity = polarity
+
+    def get(self):
+        return self.enable, self.period, self.duty, self.polarity
+
+class preset:
+    '''
+        Named pwm and servo settings for timers, the periods and ratio to
+        duty conversions are precomputed
+    '''
+    __slots__ = ('freq', 'polarity', 'smin', 'smax', 'sint', 'pperiod', 'speriod',
+        'sbase', 'sspan', 'invert')
+
+    def __init__(self, freq, polarity, smin, smax, sint):
+        self.freq = freq
+        self.polarity = polarity
+        self.smin = smin
+        self.smax = smax
+        self.sint = sint
+        self.pperiod = int(basefreq / freq)
+        self.speriod = int(sint * basefreq)
+        self.sbase = smin * basefreq
+        self.sspan = (smax - smin) * basefreq
+        self.invert = polarity == 'inversed'
+
+    def pwm(self, ratio):
+        # returns the (period, duty) for a pwm ratio
+        ratio = float(max(0, min(1, ratio)))
+        duty = int(self.pperiod * ratio)
+        return self.pperiod, self.pperiod - duty if self.invert else duty
+
+    def servo(self, ratio):
+        # returns the (period, duty) for a servo position
+        ratio = float(max(0, min(1, ratio)))
+        duty = int(self.sbase + self.sspan * ratio)
+        return self.speriod, self.speriod - duty if self.invert else duty
+
+    def get(self):
+        return {'pwmfreq': self.freq, 'polarity': self.polarity,
+            'servo': (self.smin, self.smax, self.sint)}
+
+class sequence:
+    '''
+        An uploaded waveform of pwm ratios and its sample rate, the duty
+        values are converted once for each timer period used and kept
+    '''
+    __slots__ = ('ratios', 'rate', 'duties')
+
+    def __init__(self, ratios, rate):
+        self.ratios = ratios  # array('f')
+        self.rate = rate
+        self.duties = {}  # (period, inverted): array('q') of duty values
+
+    def duty(self, period, invert):
+        duties = self.duties.get((period, invert))
+        if duties is None:
+            if invert:
+                duties = array('q', [period - int(period * r) for r in self.ratios])
+            else:
+                duties = array('q', [int(period * r) for r in self.ratios])
+            self.duties[(period, invert)] = duties
+        return duties
+
+    def get(self):
+        return {'samples': len(self.ratios), 'rate': self.rate,
+            'duration': len(self.ratios) / self.rate}
+
+class sequenceplay:
+    '''
+        A playing sequence, stepped by the server scheduler. The sample is
+        chosen from the time since the start, so timers started together stay
+        in step and late steps skip samples rather than drift
+    '''
+    __slots__ = ('chip', 'timer', 'period', 'duties', 'rate', 'begin', 'total', 'due')
+
+    def __init__(self, chip, timer, period, duties, rate, loops, begin):
+        self.chip = chip
+        self.timer = timer
+        self.period = period
+        self.duties = duties
+        self.rate = rate
+        self.begin = begin
+        self.total = len(duties) * loops if loops > 0 else None  # None = forever
+        self.due = begin
+
+    def step(self, server, now):
+        # sets the current sample, returns True when done
+        index = int((now - self.begin) * self.rate)
+        done = self.total is not None and index >= self.total - 1
+        if done:
+            index = self.total - 1
+        server._set(self.chip, self.timer, 1, self.period, self.duties[index % len(self.duties)])
+        self.due = self.begin + (index + 1) / self.rate
+        return done
+
+class pwmfade:
+    '''
+        A running fade, stepped by the server scheduler
+    '''
+    __slots__ = ('chip', 'timer', 'start', 'end', 'begin', 'duration', 'curve', 'due')
+
+    def __init__(self, chip, timer, start, end, duration, curve, now):
+        self.chip = chip
+        self.timer = timer
+        self.curve = curves[curve]
+        if self.curve[1] is not None:
+            # fade in perceived brightness, mapped back to a ratio via the table
+            start, end = start ** (1 / 2.2), end ** (1 / 2.2)
+        self.start = start
+        self.end = end
+        self.begin = now
+        self.duration = duration
+        self.due = now
+
+    def step(self, server, now):
+        # sets the timer for the current fade position, returns True when done
+        progress = 1 if self.duration <= 0 else min(1, (now - self.begin) / self.duration)
+        shape, out = self.curve
+        level = self.start + (self.end - self.start) * shape[int(progress * _steps)]
+        ratio = level if out is None else out[int(level * _steps)]
+        server._set(self.chip, self.timer, 1, *server._pwmtarget(ratio, self.chip, self.timer))
+        self.due = max(self.due + server.tick, now)  # fixed rate, skip missed steps
+        return progress >= 1
+
+class servomove:
+    '''
+        A running servo move, stepped by the server scheduler once per
+        servo interval through a precomputed table of pulse widths
+    '''
+    __slots__ = ('chip', 'timer', 'period', 'steps', 'index', 'interval', 'settle', 'due')
+
+    def __init__(self, chip, timer, period, start, end, count, profile, interval, settle, now):
+        self.chip = chip
+        self.timer = timer
+        self.period = period
+        shape = profiles[profile]
+        self.steps = [int(start + (end - start) * shape(i / count)) for i in range(1, count + 1)]
+        self.index = 0
+        self.interval = interval
+        self.settle = settle
+        self.due = now
+
+    def step(self, server, now):
+        # sets the next pulse width, returns True when done
+        if self.index < len(self.steps):
+            server._set(self.chip, self.timer, 1, self.period, self.steps[self.index])
+            self.index += 1
+            if self.index < len(self.steps):
+                self.due = max(self.due + self.interval, now)
+                return False
+            if self.settle < 0:
+                return True  # leave the servo enabled
+            self.due = now + self.settle
+            return False
+        # settled, disable to stop hunting
+        server._set(self.chip, self.timer, 0, None, None)
+        return True
+
+class setpoint:
+    '''
+        Coalescing slot for a timer, only the latest pwm or servo setting is
+        kept and applied by the scheduler, at most once per period
+    '''
+    __slots__ = ('chip', 'timer', 'period', 'target', 'last', 'applied', 'superseded', 'due')
+
+    def __init__(self, chip, timer, period):
+        self.chip = chip
+        self.timer = timer
+        self.period = period
+        self.target = None  # (enable, period, duty) waiting to be applied
+        self.last = 0  # when the last setting was applied
+        self.applied = 0
+        self.superseded = 0
+        self.due = 0
+
+    def apply(self, server, now):
+        target, self.target = self.target, None
+        self.last = now
+        self.applied += 1
+        return server._set(self.chip, self.timer, *target)
+
+    def step(self, server, now):
+        self.apply(server, now)
+        return True
+
+    def get(self):
+        return {'period': self.period, 'applied': self.applied, 'superseded': self.superseded}
+
+class journal:
+    '''
+        Append-only record of the server settings and timer states, used to
+        restore them when the server is restarted. Changes are collected
+        (latest wins) and written by a background thread every 'interval'
+        seconds, the file is rewritten as a snapshot when it has grown to
+        several times the size of the live state.
+    '''
+
+    def __init__(self, file, log, interval=1):
+        self.file = file
+        self._log = log
+        self.interval = interval
+        self.state = {}  # (kind, ..): values, the live settings
+        self.pending = {}  # (kind, ..): values or None (removed), not yet written
+        self.lock = Lock()
+        self.wake = Event()
+        self.lines = 0  # lines appended since the last snapshot
+        self.closed = False
+        self._thread = Thread(target=self._writer, daemon=True)
+
+    def load(self):
+        # read the journal into the live state, returns (state, unreadable lines)
+        from ast import literal_eval  # only needed by the server, and only here
+        state = {}
+        bad = 0
+        try:
+            with open(self.file) as entries:
+                for entry in entries:
+                    try:
+                        key, values = literal_eval(entry)
+                    except (ValueError, SyntaxError, TypeError):
+                        bad += 1  # eg. a partly written last line
+                        continue
+                    if values is None:
+                        state.pop(key, None)
+                    else:
+                        state[key] = values
+        except FileNotFoundError:
+            pass
+        self.state = state
+        return state, bad
+
+    def record(self, key, values=None):
+        with self.lock:
+            self.pending[key] = values
+
+    def start(self):
+        self._snapshot()
+        self._thread.start()
+
+    def close(self):
+        # write out any pending changes and stop the writer
+        if self._thread.is_alive():
+            self.closed = True
+            self.wake.set()
+            self._thread.join(5)
+
+    def _writer(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self._flush()
+            except OSError as e:
+                self._log('warning: cannot write journal {} :: {}'.format(self.file, repr(e)))
+            if self.closed:
+                return
+
+    def _flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        changes = [(key, values) for key, values in pending.items()
+            if self.state.get(key) != values]
+        if not changes:
+            return
+        for key, values in changes:
+            if values is None:
+                self.state.pop(key, None)
+            else:
+                self.state[key] = values
+        if self.lines + len(changes) > max(1000, 4 * len(self.state)):
+            return self._snapshot()
+        with open(self.file, 'a') as out:
+            out.write(''.join('{!r}\n'.format(change) for change in changes))
+        self.lines += len(changes)
+
+    def _snapshot(self):
+        # compact the journal, replaced in one step so it is never left partial
+        with open(self.file + '.tmp', 'w') as out:
+            out.write(''.join('{!r}\n'.format(item) for item in self.state.items()))
+        replace(self.file + '.tmp', self.file)
+        self.lines = 0
+
+class sysfs:
+    '''
+        Output backend for the /sys/class/pwm tree (the kernel sysfs API).
+        Timer property files are kept open and read or written in place.
+    '''
+
+    def __init__(self, base='/sys/class/pwm'):
+        self.base = base
+        self._chipbase = 'pwmchip'
+        self._fds = {}  # timer node: {property: (fd, buffer)}, open property files
+
+    def chips(self):
+        # returns a numerically sorted dict of {chip: (path, number of timers)}
+        try:
+            entries = listdir(self.base)
+        except OSError:
+            entries = []
+        chips = {}
+        for c in sorted(int(e[len(self._chipbase):]) for e in entries
+                if e.startswith(self._chipbase) and e[len(self._chipbase):].isdigit()):
+            chip = '{}/{}{}'.format(self.base, self._chipbase, c)
+            with open(chip + '/npwm','r') as npwm:
+                chips[c] = (chip, int(npwm.read()))
+        return chips
+
+    def stamp(self):
+        # changes when chips are added or removed (hotplug)
+        try:
+            return stat(self.base).st_mtime_ns
+        except OSError:
+            return None
+
+    def node(self, chip, timer):
+        return '{}/{}{}/pwm{}'.format(self.base, self._chipbase, chip, timer)
+
+    def exported(self, chip, timer):
+        return path.exists(self.node(chip, timer))
+
+    def export(self, chip, timer):
+        self._control(chip, timer, 'export', True)
+
+    def unexport(self, chip, timer):
+        self.forget(chip, timer)
+        self._control(chip, timer, 'unexport', False)
+
+    def _control(self, chip, timer, control, exists):
+        # (un)export a timer and wait briefly for the kernel to create or remove its node
+        with open('{}/{}{}/{}'.format(self.base, self._chipbase, chip, control), 'w') as f:
+            f.write(str(timer))
+        node = self.node(chip, timer)
+        end = perf_counter() + 0.05
+        while path.exists(node) != exists:
+            if perf_counter() > end:
+                raise OSError('{} was not {}'.format(node, 'created' if exists else 'removed'))
+            sleep(0.001)
+
+    def read(self, chip, timer):
+        node = self.node(chip, timer)
+        return (int(self._get(node, 'enable')), int(self._get(node, 'period')),
+            int(self._get(node, 'duty_cycle')), self._get(node, 'polarity'))
+
+    def write(self, chip, timer, state, enable, period, duty):
+        # only the properties that differ from the current state are written
+        node = self.node(chip, timer)
+        if not enable:
+            return self._put(node, 'enable', 0)
+        current = state[2]
+        if state[1] != period:
+            # always set duty=0 before the period is changed (may fail on initial access)
+            try:
+                self._put(node, 'duty_cycle', 0)
+                current = 0
+            except OSError:
+                pass
+            self._put(node, 'period', period)
+        if current != duty:
+            self._put(node, 'duty_cycle', duty)
+        if state[0] != 1:
+            self._put(node, 'enable', 1)
+
+    def forget(self, chip=None, timer=None):
+        # close the open property files for a timer, or all timers
+        for node in list(self._fds.keys()) if chip is None else [self.node(chip, timer)]:
+            self._closefds(node)
+
+    def _propfd(self, node, prop):
+        # returns the (fd, read buffer) for a timer property, opened on first use
+        props = self._fds.get(node)
+        if props is None:
+            props = self._fds.setdefault(node, {})
+        entry = props.get(prop)
+        if entry is None:
+            try:
+                fd = osopen(node + '/' + prop, O_RDWR)
+            except PermissionError:  # read-only property
+                fd = osopen(node + '/' + prop, O_RDONLY)
+            entry = props[prop] = (fd, bytearray(64))
+        return entry
+
+    def _closefds(self, node, prop=None):
+        # close the open property files for a node, or a single property
+        props = self._fds.get(node, {})
+        for p in list(props.keys()) if prop is None else [prop]:
+            entry = props.pop(p, None)
+            if entry is not None:
+                try:
+                    osclose(entry[0])
+                except OSError:
+                    pass
+        if not props:
+            self._fds.pop(node, None)
+
+    def _get(self, node, prop):
+        try:
+            fd, buf = self._propfd(node, prop)
+            count = preadv(fd, [buf], 0)
+        except OSError as e:
+            if e.errno not in _stale:
+                raise
+            # stale descriptor, reopen and try again
+            self._closefds(node, prop)
+            fd, buf = self._propfd(node, prop)
+            count = preadv(fd, [buf], 0)
+        return buf[:count].split(b'\n')[0].decode().strip()
+
+    def _put(self, node, prop, value):
+        # values are newline terminated, the same as 'echo <value> > <property>'
+        data = b'%d\n' % value
+        try:
+            pwrite(self._propfd(node, prop)[0], data, 0)
+        except OSError as e:
+            if e.errno not in _stale:
+                raise
+            self._closefds(node, prop)
+            pwrite(self._propfd(node, prop)[0], data, 0)
+
+class simulator:
+    '''
+        In-memory output backend, for testing and benchmarking without
+        hardware. Timers behave like sysfs timers but no I/O is done.
+    '''
+
+    def __init__(self, chips=1, timers=8):
+        self.base = 'simulator'
+        self._chips = {c: ('simulator/pwmchip{}'.format(c), timers) for c in range(chips)}
+        self._timers = {}  # (chip, timer): [enable, period, duty, polarity], exported timers
+        self.writes = 0  # settings written
+
+    def chips(self):
+        return dict(self._chips)
+
+    def stamp(self):
+        return 0
+
+    def node(self, chip, timer):
+        return 'simulator/pwmchip{}/pwm{}'.format(chip, timer)
+
+    def exported(self, chip, timer):
+        return (chip, timer) in self._timers
+
+    def export(self, chip, timer):
+        if timer not in range(self._chips.get(chip, (None, 0))[1]):
+            raise OSError(ENODEV, 'no such timer', self.node(chip, timer))
+        self._timers.setdefault((chip, timer), [0, 0, 0, 'normal'])
+
+    def unexport(self, chip, timer):
+        self._timers.pop((chip, timer), None)
+
+    def read(self, chip, timer):
+        try:
+            return tuple(self._timers[(chip, timer)])
+        except KeyError:
+            raise OSError(ENOENT, 'timer not exported', self.node(chip, timer)) from None
+
+    def write(self, chip, timer, state, enable, period, duty):
+        t = self._timers.get((chip, timer))
+        if t is None:
+            raise OSError(ENOENT, 'timer not exported', self.node(chip, timer))
+        if enable:
+            t[:3] = 1, period, duty
+        else:
+            t[0] = 0
+        self.writes += 1
+
+    def forget(self, chip=None, timer=None):
+        pass
+
+class chardev:
+    '''
+        Output backend for the PWM character devices (/dev/pwmchipN, Linux
+        6.13+). A setting is written as a waveform, period, duty and enable
+        in one ioctl. The number of timers is read from the sysfs tree.
+        'ioctl' can be replaced (eg. with a simulation) for testing.
+    '''
+
+    def __init__(self, devbase='/dev', sysbase='/sys/class/pwm', ioctl=None):
+        if ioctl is None:
+            from fcntl import ioctl
+        self.base = devbase
+        self._sysbase = sysbase
+        self._ioctl = ioctl
+        self._fds = {}  # chip: device fd
+        self._requested = set()  # (chip, timer) requested through this backend
+
+    def chips(self):
+        try:
+            entries = listdir(self.base)
+        except OSError:
+            entries = []
+        chips = {}
+        for c in sorted(int(e[7:]) for e in entries if e.startswith('pwmchip') and e[7:].isdigit()):
+            with open('{}/pwmchip{}/npwm'.format(self._sysbase, c)) as npwm:
+                chips[c] = ('{}/pwmchip{}'.format(self.base, c), int(npwm.read()))
+        return chips
+
+    def stamp(self):
+        try:
+            return stat(self.base).st_mtime_ns
+        except OSError:
+            return None
+
+    def node(self, chip, timer):
+        return '{}/pwmchip{}:{}'.format(self.base, chip, timer)
+
+    def exported(self, chip, timer):
+        # timers are exported (requested) per open device, so only ours are known
+        return (chip, timer) in self._requested
+
+    def _device(self, chip):
+        fd = self._fds.get(chip)
+        if fd is None:
+            fd = self._fds[chip] = osopen('{}/pwmchip{}'.format(self.base, chip), O_RDWR)
+        return fd
+
+    def export(self, chip, timer):
+        self._ioctl(self._device(chip), _pwmrequest, timer)
+        self._requested.add((chip, timer))
+
+    def unexport(self, chip, timer):
+        if (chip, timer) in self._requested:
+            self._ioctl(self._device(chip), _pwmfree, timer)
+            self._requested.discard((chip, timer))
+
+    def read(self, chip, timer):
+        # an inverted output is a waveform with a duty offset, read as 'inversed'
+        wf = bytearray(_pwmwf.pack(timer, 0, 0, 0, 0))
+        self._ioctl(self._device(chip), _pwmgetwf, wf, True)
+        _, _, period, duty, offset = _pwmwf.unpack(wf)
+        if period == 0:
+            return 0, 0, 0, 'normal'
+        if offset and offset + duty == period:
+            return 1, period, period - duty, 'inversed'
+        return 1, period, duty, 'normal'
+
+    def write(self, chip, timer, state, enable, period, duty):
+        if enable and state[3] == 'inversed':
+            wf = _pwmwf.pack(timer, 0, period, period - duty, duty)
+        else:
+            wf = _pwmwf.pack(timer, 0, period if enable else 0, duty if enable else 0, 0)
+        self._ioctl(self._device(chip), _pwmsetwf, wf)
+
+    def forget(self, chip=None, timer=None):
+        pass
+
+# Output backends, selected by name when the server is started
+backends = {'sysfs': sysfs, 'sim': simulator, 'chardev': chardev}
+
 class pypwm_server:
     '''
         PWM node control daemon (server)
         Needs root..
     '''
 
-    def __init__(self, logfile=None, verbose=False):
+    # 'command':([possible argument lengths],[arguments that are floats],[strings])
+    _cmdset = { 'info':([1],[],[]), 'states':([0],[],[]),
+                'open':([2],[],[]), 'close':([2],[],[]),
+                'pwm':([2,3],[2],[]), 'pwmfreq':([0,1],[0],[]),
+                'servo':([3],[2],[]), 'servoset':([0,2,3],[0,1,2],[]),
+                'disable':([2],[],[]), 'cachestats':([0],[],[]),
+                'resync':([0,2],[],[]), 'rescan':([0],[],[]),
+                'fade':([5,6],[2,3,4],[5]),
+                'servomove':([4,5,6],[2,5],[3,4]), 'caps':([0],[],[]),
+                'stats':([0],[],[]), 'coalesce':([0,2,3],[2],[]),
+                'preset':([0,1,2,3,5,6],[1,3,4,5],[0,2]), 'assign':([2,3],[],[2]),
+                'sequence':([0,1,2],[1],[0]), 'play':(list(range(4, 67, 2)),[],[0]),
+                'profile':([1,2],[0],[]),}
+
+    def __init__(self, logfile=None, verbose=False, timeout=60, tick=0.01,
+            sock=socket, sysbase='/sys/class/pwm', metrics=None, interval=10,
+            logsize=1000000, logage=0, logkeep=3, peercred=False, uids=(), gids=(),
+            journal=None, backend=None, realtime=0, cpus=()):
+        self._begin = perf_counter()
         self.logfile = logfile
+        self.logsize = logsize  # rotate the logfile at this size (bytes, 0 = never)
+        self.logage = logage  # and/or after this time (seconds, 0 = never)
+        self.logkeep = logkeep  # number of rotated logfiles kept
         self._verbose = verbose
-        self.sock = socket
+        self.sock = sock
+        self.timeout = timeout  # idle client timeout (float, seconds, 0 = never)
+        self.tick = tick  # scheduler step interval for fades (float, seconds)
+        self._jobs = {}  # (chip, timer): running scheduler job (fade etc.)
+        self._wake = Event()  # wakes the scheduler when jobs are added
+        self._dispatch = {cmd: getattr(self, '_' + cmd) for cmd in self._cmdset.keys()}
         self.running = False
-        self._sysbase  = '/sys/class/pwm'
-        self._chipbase = 'pwmchip'
+        self._locks = {}  # per timer locks, serializes timer access between clients
+        self._cache = {}  # (chip, timer): timerstate(), avoids re-reading the timers
+        self._hits = 0
+        self._misses = 0
+        self._started = time()
+        self._cmdstats = {cmd: cmdstats() for cmd in list(self._cmdset.keys()) + ['batch']}
+        self._counters = dict.fromkeys(('connections', 'active', 'authfail',
+            'timeouts', 'resets', 'unknown', 'logdrops', 'logsuppressed', 'superseded'), 0)
+        self._statslock = Lock()  # counters and stats are updated by all client threads
+        self._iotime = iotime()
+        self._latency = histogram()  # command received to timer written
+        self._jitter = histogram()  # scheduler job steps, time after due
+        # realtime: SCHED_FIFO priority (1-99, 0 = off) for the server threads,
+        # which also locks memory and quietens the garbage collector. cpus: the
+        # cpus the server threads run on (empty = any)
+        self.realtime = realtime
+        self.cpus = cpus
+        self._rtstate = {}  # the realtime settings that were applied
+        self._profiling = Lock()  # held while a profile is running
+        self._profiles = None  # thread id: cProfile.Profile(), while profiling
+        self._profiled = 0  # profiled calls in progress
+        self._profilelock = Lock()
+        self._watchers = []  # watch subscriptions, replaced (not modified) on change
+        self._watchlock = Lock()  # serializes replacing the watchers list
+        self._setpoints = {}  # (chip, timer): setpoint(), timers in coalescing mode
+        self._presets = {}  # name: preset()
+        self._assigned = {}  # (chip, timer): preset(), timers using a preset
+        self._sequences = {}  # name: sequence()
+        self._journal = None  # journal(), set once the journal has been restored
+        self.metrics = metrics  # prometheus text file, written every 'interval' seconds
+        self.interval = interval
+        # peercred: authorise clients by the uid/gid of the connecting process
+        # (SO_PEERCRED) instead of the authkey challenge. root, the server user
+        # and the listed users and groups are allowed; with no lists the socket
+        # permissions alone control access.
+        self.peercred = peercred
+        self.uids = {u if type(u) == int else getpwnam(u).pw_uid for u in uids}
+        self.gids = {g if type(g) == int else getgrnam(g).gr_gid for g in gids}
+        self._allowed = {}  # uid: (time, allowed), group lookups are cached
+        # all timer access is through the backend, sysfs unless another is given
+        self._backend = sysfs(sysbase) if backend is None else backend
+        self._chips = {}  # chip number: (chip path, number of timers)
+        self._nodes = {}  # (chip, timer): timer node path
+        self._exported = set()  # (chip, timer) of exported timers
+        self._treetime = None  # pwm tree mtime at last scan
 
         # sensible defaults for pwm and servo
         self.pfreq = 1000   # pwm default, (float, Hz)
@@ -45,6 +864,15 @@ class pypwm_server:
         self.smin = 0.0006  # servo default min pulse (float, seconds)
         self.smax = 0.0023  # servo default max pulse (float, seconds)
 
+        # Log lines are queued and written by a background thread, the queue is
+        # bounded and lines are dropped (and counted) rather than block.
+        self._logq = Queue(maxsize=1024)
+        self._lograte = {}  # warning: [window start, count, suppressed]
+        self._reopen = False
+        self._logthread = Thread(target=self._logwriter, daemon=True)
+        self._logthread.start()
+        atexit.register(self.closelog)
+
         # initialise and check logfile? disable file logging if n/a
         self._log('')
         self._log('PWM server v{} init'.format(version))
@@ -53,137 +881,425 @@ class pypwm_server:
                 ' (verbose)' if verbose else ''))
 
         # Do initial scan for devices
-        self._log('Scanning {} for pwm timers'.format(self._sysbase))
-        chips = self._chipscan()
+        self._log('Scanning {} for pwm timers'.format(self._backend.base))
+        chips = self._rescan()
         if len(chips) == 0:
             self._log('Warning: No PWM devices available!')
         else:
             self._log('PWM devices:')
-            for chip in chips.keys():
-                self._log('- {} with {} timers'.format(chip, chips[chip]))
+            for chip in chips.values():
+                self._log('- {} with {} timers'.format(*chip))
+
+        # Restore the settings and timers saved in the journal
+        if journal is not None:
+            self._restore(journal)
 
     def _log(self, string):
-        out = log = ''
-        for line in string.strip().split('\n'):
-            out += '{}: {}\n'.format(name, line)
-            log += '{} :: {}\n'.format(ctime(), line)
-        print(out.strip(), flush=True)
-        if self.logfile is not None:
-            with open(self.logfile,'a') as l:
-                l.write(log)
+        # queue a message for the log writer, returns the message
+        now = time()
+        message = string
+        if string[:7].lower() == 'warning':
+            # repeated warnings are limited to 10 per minute each
+            rate = self._lograte.get(string)
+            if rate is None or now - rate[0] > 60:
+                if rate is not None and rate[2]:
+                    message += ' (+{} suppressed)'.format(rate[2])
+                elif len(self._lograte) > 256:
+                    self._lograte.clear()
+                self._lograte[string] = [now, 1, 0]
+            elif rate[1] < 10:
+                rate[1] += 1
+            else:
+                rate[2] += 1
+                self._count('logsuppressed')
+                return string
+        try:
+            self._logq.put_nowait((now, message))
+        except Full:
+            self._count('logdrops')
         return string
 
-    def _chipscan(self):
-        #returns a numerically sorted dict with <path>:<number of pwms>
-        base = '{}/{}'.format(self._sysbase,self._chipbase)
-        chiplist = glob('{}*'.format(base))
-        chiplist = sorted(chiplist, key=lambda x:float(findall('(\\d+)',x)[0]))
-        chips = {}
-        for chip in chiplist:
-            with open(chip + '/npwm','r') as npwm:
-                chips[chip] = int(npwm.read())
+    def _logwriter(self):
+        # Writes queued log messages, the logfile is kept open and rotated
+        logfile = None
+        while True:
+            entry = self._logq.get()
+            if entry is None or self._reopen:
+                if logfile is not None:
+                    logfile.close()
+                    logfile = None
+                self._reopen = False
+                if entry is None:
+                    return
+            if logfile is None and self.logfile is not None:
+                try:
+                    logfile = open(self.logfile, 'a')
+                    opened = time()
+                except OSError as e:
+                    print('{}: error: cannot open logfile {}, file logging disabled :: {}'.format(
+                        name, self.logfile, repr(e)))
+                    self.logfile = None
+            out = log = ''
+            for line in entry[1].strip().split('\n'):
+                out += '{}: {}\n'.format(name, line)
+                log += '{} :: {}\n'.format(ctime(entry[0]), line)
+            print(out.strip())
+            if logfile is not None:
+                logfile.write(log)
+                if (self.logsize and logfile.tell() >= self.logsize) or (
+                        self.logage and time() - opened >= self.logage):
+                    logfile.close()
+                    logfile = None
+                    self._rotate()
+            if self._logq.empty():
+                stdout.flush()
+                if logfile is not None:
+                    logfile.flush()
+
+    def _rotate(self):
+        # logfile -> logfile.1 -> logfile.2 .. logfile.<logkeep>
+        try:
+            for n in range(self.logkeep - 1, 0, -1):
+                if path.exists('{}.{}'.format(self.logfile, n)):
+                    rename('{}.{}'.format(self.logfile, n), '{}.{}'.format(self.logfile, n + 1))
+            if self.logkeep > 0:
+                rename(self.logfile, self.logfile + '.1')
+            else:
+                remove(self.logfile)
+        except OSError as e:
+            print('{}: error: logfile rotation failed :: {}'.format(name, repr(e)))
+
+    def reopenlog(self):
+        # reopen the logfile on the next message (eg. after external rotation)
+        self._reopen = True
+        self._log('info: reopening logfile')
+
+    def closelog(self):
+        # write out any queued messages and stop the log writer
+        if self._logthread.is_alive():
+            self._logq.put(None)
+            self._logthread.join(5)
+
+    def _record(self, key, values=None):
+        # note a change for the journal (if any), values None removes the key
+        if self._journal is not None:
+            self._journal.record(key, values)
+
+    def _restore(self, file):
+        # Applies the journal in one pass, settings first and then the timers,
+        # timers are only written where they differ from the journal
+        start = perf_counter()
+        saved = journal(file, self._log)
+        state, bad = saved.load()
+        if bad:
+            self._log('warning: skipped {} unreadable journal entries'.format(bad))
+        # enabled timers are only restored within the same boot, after a reboot
+        # the outputs stay off until a client sets them again
+        boot = _bootid()
+        rebooted = state.get(('boot',)) != (boot,)
+        if rebooted:
+            enabled = [key for key, values in state.items()
+                if type(key) == tuple and key[:1] == ('timer',) and values[0] == 1]
+            for key in enabled:
+                del state[key]
+            if enabled:
+                self._log('info: not enabling {} journaled timers after a reboot'.format(len(enabled)))
+        state[('boot',)] = (boot,)
+        order = ('pwmfreq', 'servoset', 'preset', 'assign', 'coalesce', 'timer')
+        changed = 0
+        entries = [(order.index(key[0]), key, values) for key, values in state.items()
+            if type(key) == tuple and key[:1] and key[0] in order]
+        for _, key, values in sorted(entries, key=lambda entry: entry[0]):
+            try:
+                if key[0] == 'pwmfreq':
+                    self._pwmfreq(*values)
+                elif key[0] == 'servoset':
+                    self._servoset(*values)
+                elif key[0] == 'preset':
+                    self._preset(key[1], *values)
+                elif key[0] in ('assign', 'coalesce'):
+                    self._dispatch[key[0]](*key[1:], *values)
+                elif self._restoretimer(*key[1:], *values, keep=None if rebooted else state):
+                    changed += 1
+            except Exception as e:
+                self._log('error: cannot restore {} {} :: {}'.format(key, values, repr(e)))
+        try:
+            saved.start()
+        except OSError as e:
+            return self._log('error: cannot write journal {}, not journaling :: {}'.format(
+                file, repr(e)))
+        self._journal = saved
+        atexit.register(saved.close)
+        self._log('info: restored {} entries from {}, {} timers changed, in {:.1f}ms'.format(
+            len(state), file, changed, (perf_counter() - start) * 1000))
+
+    def _restoretimer(self, chip, timer, enable, period, duty, keep=None):
+        # export and set a timer as journaled, returns True if anything changed.
+        # Given a 'keep' dict, a timer that is still enabled is left as it is (it
+        # may have been set after the journal was written) and its current
+        # setting is put in the dict instead
+        with self._timerlock(chip, timer):
+            opened = False
+            if not self._isopen(chip, timer):
+                if self._open(chip, timer) is not True:
+                    return False
+                opened = True
+            if enable is None:  # exported, never set
+                return opened
+            state = self._gettimer(chip, timer)
+            if state is None:
+                return False
+            if keep is not None and not opened and state[0] == 1:
+                duty = state[1] - state[2] if state[3] == 'inversed' else state[2]
+                keep[('timer', chip, timer)] = (1, state[1], duty)
+                return False
+            if enable == 0:
+                if state[0] == 0:
+                    return opened
+                return self._set(chip, timer, 0, None, None) is True
+            target = period - duty if state[3] == 'inversed' else duty
+            if tuple(state[:3]) == (1, period, target):
+                return opened
+            return self._set(chip, timer, 1, period, duty, state) is True
+
+    def _rescan(self):
+        # (re)builds the chip and timer index, returns {chip: (path, timers)}
+        self._treetime = self._backend.stamp()
+        chips = self._backend.chips()
+        nodes = {}
+        exported = set()
+        for c, (chip, npwm) in chips.items():
+            for timer in range(npwm):
+                nodes[(c, timer)] = self._backend.node(c, timer)
+                if self._backend.exported(c, timer):
+                    exported.add((c, timer))
+        self._chips, self._nodes, self._exported = chips, nodes, exported
         return chips
 
-    def _getprop(self, node):
-        with open(node, 'r') as file:
-           value = file.read().strip()
-        return value
+    def _checktree(self):
+        # cheap check for pwm tree changes (hotplug), rescan if needed
+        if self._backend.stamp() != self._treetime:
+            if self._verbose:
+                self._log('info: {} changed, rescanning'.format(self._backend.base))
+            self._rescan()
+
+    def _node(self, chip, timer):
+        node = self._nodes.get((chip, timer))
+        if node is None:  # not in the index
+            node = self._backend.node(chip, timer)
+        return node
+
+    def _isopen(self, chip, timer):
+        if (chip, timer) in self._exported:
+            return True
+        if self._backend.exported(chip, timer):
+            # exported by another process since the last scan
+            self._exported.add((chip, timer))
+            return True
+        return False
+
+    def _gettimer(self, chip, timer):
+        # served from the cache when possible, otherwise read and cached.
+        # Returns None if the timer has been unexported by another process.
+        state = self._cache.get((chip, timer))
+        if state is not None:
+            with self._statslock:
+                self._hits += 1
+            return state.get()
+        with self._statslock:
+            self._misses += 1
+        start = perf_counter()
+        try:
+            state = self._backend.read(chip, timer)
+        except OSError as e:
+            if e.errno not in (ENOENT, ENODEV):
+                raise
+            self._unexported(chip, timer)
+            return None
+        finally:
+            self._iotime.seconds += perf_counter() - start
+        self._cache[(chip, timer)] = timerstate(*state)
+        return state
 
-    def _gettimer(self, node):
-        enable = int(self._getprop(node + '/enable'))
-        period = int(self._getprop(node + '/period'))
-        duty = int(self._getprop(node + '/duty_cycle'))
-        polarity = str(self._getprop(node + '/polarity'))
-        return enable, period, duty, polarity
+    def _unexported(self, chip, timer):
+        # forget a timer that has gone (unexported outside the server)
+        self._exported.discard((chip, timer))
+        self._cache.pop((chip, timer), None)
+        self._backend.forget(chip, timer)
 
     def _info(self,client):
         self._log('info: client {} sent info request'.format(client))
-        return version, getpid(), getuid(), getgid(), self._sysbase
+        return version, getpid(), getuid(), getgid(), self._backend.base
 
     def _states(self):
+        self._checktree()
         pwms = {}
-        chips = self._chipscan()
-        for chip in chips.keys():
-            c = chip[len(self._sysbase + self._chipbase)+1:]
-            pwms[c] = {}
-            for timer in range(chips[chip]):
-                node = '{}/pwm{}'.format(chip, timer)
-                pwms[c][timer] = self._gettimer(node) if path.exists(node) else None
+        for c, (chip, npwm) in self._chips.items():
+            pwms[str(c)] = {}
+            for timer in range(npwm):
+                # timers may be exported and unexported by other processes
+                if self._backend.exported(c, timer):
+                    self._exported.add((c, timer))
+                    with self._timerlock(c, timer):
+                        pwms[str(c)][timer] = self._gettimer(c, timer)
+                else:
+                    if (c, timer) in self._exported:
+                        self._unexported(c, timer)
+                    pwms[str(c)][timer] = None
         return pwms
 
     def _get(self, chip, timer):
-        node = '{}/{}{}/pwm{}'.format(self._sysbase,
-            self._chipbase, chip, timer)
-        if not path.exists(node):
+        if not self._isopen(chip, timer):
             return None
-        return tuple(self._gettimer(node))
-
-    def _set(self, chip, timer, enable, period, duty):
-        def setprop(n, p, v, r = True):
-            # Set an individual node+property with error trap.
+        state = self._gettimer(chip, timer)
+        return None if state is None else tuple(state)
+
+    def _set(self, chip, timer, enable, period, duty, state=None):
+        def write(state, *setting):
+            # write a setting with error trap, the backend only writes what has changed.
+            # returns True, or the error
+            start = perf_counter()
             try:
-                with open(n + '/' + p, 'w') as f:
-                    f.write(str(v))
+                self._backend.write(chip, timer, state, *setting)
             except (FileNotFoundError, OSError) as e:
-                if r:
-                    self._log('error: failed to set {}/{} :: {}'.format(n, p, repr(e)))
-                return False
+                if e.errno in (ENOENT, ENODEV):
+                    # unexported by another process
+                    self._unexported(chip, timer)
+                    return self._log('error: attempt to set unexported timer {}'.format(node))
+                # cannot be sure of the timer state, re-read on next access
+                self._cache.pop((chip, timer), None)
+                self._notify(chip, timer)
+                return self._log('error: failed to set {} :: {}'.format(node, repr(e)))
+            finally:
+                self._iotime.seconds += perf_counter() - start
+            if self._iotime.start:
+                with self._statslock:
+                    self._latency.record(perf_counter() - self._iotime.start)
             return True
 
         # Set properties for a timer
-        node = '{}/{}{}/pwm{}'.format(self._sysbase, self._chipbase, chip, timer)
-        if not path.exists(node):
+        node = self._node(chip, timer)
+        if not self._isopen(chip, timer):
             return self._log('error: attempt to set unexported timer {}'.format(node))
         if not enable:
-            return setprop(node, 'enable', 0)
+            written = write(None, 0, None, None)
+            if written is not True:
+                return written
+            if (chip, timer) in self._cache:
+                self._cache[(chip, timer)].enable = 0
+            self._notify(chip, timer)
+            self._record(('timer', chip, timer), (0, None, None))
+            return True
         if duty > period:
             return self._log('error: cannot set duty={} greater than period={}'.format(duty, period))
-        state = list(self._gettimer(node))
+        # state may be supplied by the caller if already read
+        state = self._gettimer(chip, timer) if state is None else state
+        if state is None:
+            return self._log('error: attempt to set unexported timer {}'.format(node))
+        setting = (1, period, duty)  # journaled as requested, before any inversion
         if state[3] == 'inversed':  # allow for inversion
             duty = period - duty
-        if state[1] != period:  # period
-            # always set duty=0 before frequency is changed (may fail on initial access)
-            setprop(node, 'duty_cycle', 0, False)
-            state[2] = 0
-            setprop(node, 'period', period)
-        if state[2] != duty:  # duty
-            setprop(node, 'duty_cycle', duty)
-        if state[0] != 1:  # enable
-            setprop(node, 'enable', 1)
+        written = write(state, 1, period, duty)
+        if written is not True:
+            return written
+        self._cache[(chip, timer)] = timerstate(1, period, duty, state[3])
+        self._notify(chip, timer)
+        self._record(('timer', chip, timer), setting)
         # do not log to disk unless requested (fills disk and causes extra load)
         if self._verbose:
-            self._log('info: set {} = {}'.format(node, list(self._gettimer(node))))
+            self._log('info: set {} = {}'.format(node, [1, period, duty, state[3]]))
         return True
 
+    def _notify(self, chip, timer):
+        # queue the timer state for matching watchers, called with the timer locked
+        watchers = self._watchers
+        if not watchers:
+            return
+        try:
+            state = self._get(chip, timer)
+        except (FileNotFoundError, OSError, ValueError):
+            return
+        for w in watchers:
+            if w.matches(chip, timer):
+                with w.lock:
+                    w.pending[(chip, timer)] = state
+                w.wake.set()
+
+    def _watch(self, conn, args):
+        # Sends the matching timer states, then changes as they happen, until
+        # the client disconnects. Changes are coalesced per client, a slow
+        # client only gets the latest state of each timer.
+        try:
+            if len(args) > 2:
+                raise ValueError
+            w = watcher(*[int(float(a)) for a in args])
+        except ValueError:
+            return conn.send('client error: bad arguments for \'watch\'')
+        self._checktree()
+        for key in sorted(self._nodes.keys()):
+            if w.matches(*key):
+                with self._timerlock(*key):
+                    w.pending[key] = self._get(*key)
+        w.wake.set()
+        with self._watchlock:
+            self._watchers = self._watchers + [w]
+        if self._verbose:
+            self._log('info: watch started {}'.format(' '.join(args)))
+        sent = {}
+        try:
+            while self.running:
+                # an empty update is sent after 'timeout' idle seconds, this
+                # finds clients that have gone away
+                woken = w.wake.wait(self.timeout or None)
+                w.wake.clear()
+                with w.lock:
+                    pending, w.pending = w.pending, {}
+                events = []
+                for key, state in sorted(pending.items()):
+                    if key not in sent or sent[key] != state:
+                        events.append((*key, state))
+                        sent[key] = state
+                if events or not woken:
+                    conn.send(events)
+        finally:
+            with self._watchlock:
+                self._watchers = [x for x in self._watchers if x is not w]
+
     def _open(self, chip, timer):
-        node = '{}/{}{}'.format(self._sysbase, self._chipbase, chip)
-        if path.exists(node + '/pwm' + str(timer)):
+        node = self._node(chip, timer)
+        if self._isopen(chip, timer):
             return True
+        start = perf_counter()
         try:
-            with open(node + '/export', 'w') as export:
-                export.write(str(timer))
+            self._backend.export(chip, timer)
         except (FileNotFoundError, OSError) as e:
-            return self._log('error: cannot access {}/export :: {}'.format(node, repr(e)))
-        if not path.exists(node + '/pwm' + str(timer)):
-            return self._log('error: failed to create {}/pwm'.format(node))
-        else:
-            self._log('info: opened: {}/pwm{}'.format(node, timer))
-            return True
+            return self._log('error: cannot open {} :: {}'.format(node, repr(e)))
+        finally:
+            self._iotime.seconds += perf_counter() - start
+        self._exported.add((chip, timer))
+        self._log('info: opened: {}'.format(node))
+        self._notify(chip, timer)
+        self._record(('timer', chip, timer), (None, None, None))
+        return True
 
     def _close(self, chip, timer):
-        node = '{}/{}{}'.format(self._sysbase, self._chipbase, chip)
-        if not path.exists(node + '/pwm' + str(timer)):
+        node = self._node(chip, timer)
+        self._cache.pop((chip, timer), None)
+        self._exported.discard((chip, timer))
+        if not self._backend.exported(chip, timer):
             return True
+        start = perf_counter()
         try:
-            with open(node + '/unexport', 'w') as unexport:
-                unexport.write(str(timer))
+            self._backend.unexport(chip, timer)
         except (FileNotFoundError, OSError) as e:
-            return self._log('error: cannot access {}/unexport :: {}'.format(node, repr(e)))
-        if path.exists(node + '/pwm' + str(timer)):
-            return self._log('error: failed to destroy {}/pwm'.format(node))
-        else:
-            self._log('info: closed: {}/pwm{}'.format(node, timer))
-            return True
+            self._exported.add((chip, timer))
+            return self._log('error: cannot close {} :: {}'.format(node, repr(e)))
+        finally:
+            self._iotime.seconds += perf_counter() - start
+        self._log('info: closed: {}'.format(node))
+        self._notify(chip, timer)
+        self._record(('timer', chip, timer))
+        return True
 
     def _f2p(self, freq, ratio):
         if freq == 0:  # div by zero.
@@ -206,23 +1322,40 @@ class pypwm_server:
                 return None
             else:
                 f, r = self._p2f(state[1],state[2])
-                return round(1 - r, 3) if state[3] == 'inversed' else r, f
+                p = self._assigned.get((chip, timer))
+                inverted = (state[3] == 'inversed') != (p is not None and p.invert)
+                return round(1 - r, 3) if inverted else r, f
+        return self._set(chip, timer, 1, *self._pwmtarget(ratio, chip, timer))
+
+    def _pwmtarget(self, ratio, chip=None, timer=None):
+        # returns the (period, duty) for a pwm ratio, from the timer's preset if any
+        p = self._assigned.get((chip, timer))
+        if p is not None:
+            return p.pwm(ratio)
         ratio = float(max(0, min(1, ratio)))
-        return self._set(chip, timer, 1, *self._f2p(self.pfreq, ratio))
+        return self._f2p(self.pfreq, ratio)
 
     def _pwmfreq(self, freq = None):
         if freq is not None:
             self.pfreq = freq
+            self._record(('pwmfreq',), (freq,))
             if self._verbose:
                 self._log('info: pwm default frequency set to {}'.format(freq))
         return self.pfreq
 
     def _servo(self, chip, timer, ratio):
+        return self._set(chip, timer, 1, *self._servotarget(ratio, chip, timer))
+
+    def _servotarget(self, ratio, chip=None, timer=None):
+        # returns the (period, duty) for a servo position, from the timer's preset if any
+        p = self._assigned.get((chip, timer))
+        if p is not None:
+            return p.servo(ratio)
         ratio = float(max(0, min(1, ratio)))
         value = self.smin + ((self.smax - self.smin) * ratio)
         period = int(self.sint * basefreq)
         duty_cycle = int(value * basefreq)
-        return self._set(chip, timer, 1, period, duty_cycle)
+        return period, duty_cycle
 
     def _servoset(self, minpulse=None, maxpulse=None, interval = None):
         smin = self.smin if minpulse is None else float(minpulse)
@@ -233,32 +1366,444 @@ class pypwm_server:
         if smin > smax:
             return 'error: minpulse ({}) cannot be greater than maxpulse ({})'.format(smin, smax)
         self.smin, self.smax, self.sint = smin, smax, sint
+        self._record(('servoset',), (smin, smax, sint))
         if self._verbose:
             self._log('info: servo defaults set to {} {} {}'.format(smin, smax, sint))
         return self.smin, self.smax, self.sint
 
+    def _preset(self, name=None, freq=None, polarity='normal', minpulse=None,
+            maxpulse=None, interval=None):
+        # define (or with freq 0 remove) a named preset, or return the presets
+        if name is None:
+            return {n: dict(p.get(), timers=sorted(k for k, a in self._assigned.items() if a is p))
+                for n, p in self._presets.items()}
+        if freq is None:
+            if name not in self._presets:
+                return 'error: unknown preset \'{}\''.format(name)
+            return self._presets[name].get()
+        if freq <= 0:
+            old = self._presets.pop(name, None)
+            for key in [k for k, a in self._assigned.items() if a is old]:
+                self._record(('assign', *key))
+            self._assigned = {k: a for k, a in self._assigned.items() if a is not old}
+            self._record(('preset', name))
+            return True
+        if polarity not in ('normal', 'inversed'):
+            return 'client error: polarity must be \'normal\' or \'inversed\''
+        smin = self.smin if minpulse is None else minpulse
+        smax = self.smax if maxpulse is None else maxpulse
+        sint = self.sint if interval is None else interval
+        if smax > sint or smin > smax:
+            return 'error: servo pulses must be minpulse <= maxpulse <= interval'
+        new = preset(freq, polarity, smin, smax, sint)
+        old = self._presets.get(name)
+        self._presets[name] = new
+        self._record(('preset', name), (freq, polarity, smin, smax, sint))
+        # timers using a redefined preset follow it
+        self._assigned = {k: new if a is old else a for k, a in self._assigned.items()}
+        if self._verbose:
+            self._log('info: preset {} set to {}'.format(name, new.get()))
+        return True
+
+    def _assign(self, chip, timer, name=None):
+        # use a preset for a timer, or the server defaults if no name given
+        if name is None:
+            self._assigned.pop((chip, timer), None)
+        elif name not in self._presets:
+            return 'error: unknown preset \'{}\''.format(name)
+        else:
+            self._assigned[(chip, timer)] = self._presets[name]
+        self._record(('assign', chip, timer), None if name is None else (name,))
+        if self._verbose:
+            self._log('info: timer {} {} uses {}'.format(chip, timer,
+                'defaults' if name is None else 'preset ' + name))
+        return True
+
+    def _sequence(self, name=None, rate=None, data=None):
+        # store a sequence; data is the pwm ratios as packed 32 bit floats
+        # (array('f')). With no data returns, or with rate 0 removes, sequences
+        if name is None:
+            return {n: seq.get() for n, seq in self._sequences.items()}
+        if rate is None:
+            if name not in self._sequences:
+                return 'error: unknown sequence \'{}\''.format(name)
+            return self._sequences[name].get()
+        if rate <= 0:
+            self._sequences.pop(name, None)
+            return True
+        if data is None:
+            return 'client error: no samples for sequence \'{}\''.format(name)
+        if len(data) == 0 or len(data) % 4 or len(data) > 4 * 1000000:
+            return 'client error: sequence data must be 1 to 1000000 packed floats'
+        ratios = array('f')
+        ratios.frombytes(data)
+        ratios = array('f', [max(0.0, min(1.0, r)) for r in ratios])
+        seq = self._sequences[name] = sequence(ratios, rate)
+        seq.duty(self._pwmtarget(0)[0], False)  # convert for the default period now
+        if self._verbose:
+            self._log('info: sequence {} stored, {} samples at {}/s'.format(name, len(ratios), rate))
+        return True
+
+    def _play(self, name, loops, *timers):
+        # start a sequence on one or more timers, in step. loops 0 = forever
+        seq = self._sequences.get(name)
+        if seq is None:
+            return 'error: unknown sequence \'{}\''.format(name)
+        timers = sorted(set(zip(timers[::2], timers[1::2])))
+        for chip, timer in timers:
+            if not self._isopen(chip, timer):
+                return self._log('error: attempt to play on unexported timer {}'.format(
+                    self._node(chip, timer)))
+        jobs = []
+        for chip, timer in timers:
+            period = self._pwmtarget(0, chip, timer)[0]
+            p = self._assigned.get((chip, timer))
+            jobs.append(((chip, timer), period, seq.duty(period, p is not None and p.invert)))
+        locks = [self._timerlock(*t) for t in timers]
+        for lock in locks:
+            lock.acquire()
+        try:
+            begin = perf_counter()
+            for key, period, duties in jobs:
+                self._jobs[key] = sequenceplay(*key, period, duties, seq.rate, loops, begin)
+        finally:
+            for lock in locks:
+                lock.release()
+        self._wake.set()
+        if self._verbose:
+            self._log('info: playing {} on {}'.format(name, timers))
+        return True
+
+    def _coalesce(self, chip=None, timer=None, period=None):
+        # enable (period > 0, default is the servo interval) or disable (period
+        # 0) coalescing for a timer, with no arguments returns the current slots
+        if chip is None:
+            return {'{} {}'.format(*key): slot.get() for key, slot in self._setpoints.items()}
+        if period is None:
+            p = self._assigned.get((chip, timer))
+            period = self.sint if p is None else p.sint
+        period = max(0, period)
+        self._record(('coalesce', chip, timer), (period,) if period else None)
+        if period == 0:
+            self._setpoints.pop((chip, timer), None)
+        elif (chip, timer) in self._setpoints:
+            self._setpoints[(chip, timer)].period = period
+        else:
+            self._setpoints[(chip, timer)] = setpoint(chip, timer, period)
+        if self._verbose:
+            self._log('info: coalesce {} {} period {}s'.format(chip, timer, period))
+        return True
+
+    def _setpoint(self, slot, target):
+        # latest value wins, applied now if the period has passed since the last
+        # setting, otherwise by the scheduler when it has
+        if not self._isopen(slot.chip, slot.timer):
+            return self._log('error: attempt to set unexported timer {}'.format(
+                self._node(slot.chip, slot.timer)))
+        if slot.target is not None:
+            slot.superseded += 1
+            self._count('superseded')
+        slot.target = target
+        key = (slot.chip, slot.timer)
+        if self._jobs.get(key) is slot:
+            return True  # already scheduled
+        self._jobs.pop(key, None)  # cancel any fade
+        now = perf_counter()
+        if now - slot.last >= slot.period:
+            return slot.apply(self, now)
+        slot.due = slot.last + slot.period
+        self._jobs[key] = slot
+        self._wake.set()
+        return True
+
     def _disable(self, chip, timer):
         if self._verbose:
             self._log('info: disabling {} {}'.format(chip, timer))
         return self._set(chip, timer, 0, None, None)
 
+    def _caps(self):
+        # server capabilities, used by clients to negotiate the protocol
+        return {'binary': (_bversion,), 'pipeline': True}
+
+    def _cachestats(self):
+        with self._statslock:
+            return {'hits': self._hits, 'misses': self._misses, 'timers': len(self._cache)}
+
+    def _count(self, counter, n=1):
+        with self._statslock:
+            self._counters[counter] += n
+
+    def _stats(self):
+        # counters and histograms, only commands that have been called are listed
+        with self._statslock:
+            return {'uptime': time() - self._started, **self._counters, 'buckets': buckets,
+                'commands': {cmd: stats.get() for cmd, stats in self._cmdstats.items() if stats.calls},
+                'latency': self._latency.get(), 'jitter': self._jitter.get(), 'realtime': self._rtstate}
+
+    def _profile(self, seconds, top=20):
+        # Profiles the commands and scheduler jobs started in the next 'seconds',
+        # writes the stats next to the logfile (or socket) and returns the 'top'
+        # functions by their own time. Only for root and the server user.
+        from pstats import Stats
+        if self._iotime.uid not in (0, getuid()):
+            return 'error: \'profile\' is only allowed for root and the server user'
+        if not 0 < seconds <= 600:
+            return 'client error: profile time must be more than 0 and up to 600 seconds'
+        if not self._profiling.acquire(False):
+            return 'error: a profile is already running'
+        try:
+            self._log('info: profiling for {}s'.format(seconds))
+            self._profiles = profiles = {}
+            sleep(seconds)
+            self._profiles = None
+            # let profiled calls that are still running finish
+            end = perf_counter() + 5
+            while self._profiled and perf_counter() < end:
+                sleep(0.001)
+        finally:
+            self._profiles = None
+            self._profiling.release()
+        stats = Stats(*profiles.values())
+        out = '{}/pyPWMd-{}.prof'.format(
+            path.dirname(self.logfile or self.sock) or '.', strftime('%Y%m%d-%H%M%S'))
+        try:
+            stats.dump_stats(out)
+            self._log('info: profile written to {}'.format(out))
+        except OSError as e:
+            self._log('error: cannot write profile {} :: {}'.format(out, repr(e)))
+            out = None
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])[:top]
+        return {'file': out, 'seconds': seconds, 'threads': len(profiles),
+            'calls': stats.total_calls, 'time': stats.total_tt,
+            'top': [(round(tt, 6), round(ct, 6), nc, '{2} ({0}:{1})'.format(*func))
+                for func, (cc, nc, tt, ct, callers) in rows]}
+
+    def _profiledcall(self, fn, *args):
+        # runs fn with this thread's profiler, only used while profiling
+        from cProfile import Profile
+        with self._profilelock:
+            self._profiled += 1  # counted first, so a closing profile waits for us
+        try:
+            profiles = self._profiles
+            if profiles is None:
+                return fn(*args)
+            profiler = profiles.get(get_ident())
+            if profiler is None:
+                profiler = profiles.setdefault(get_ident(), Profile())
+            return profiler.runcall(fn, *args)
+        finally:
+            with self._profilelock:
+                self._profiled -= 1
+
+    def _resync(self, chip=None, timer=None):
+        # drop cached timer states, they are re-read from sysfs on next access
+        # (stale property files are detected and reopened when next used)
+        if chip is None:
+            self._cache.clear()
+        else:
+            self._cache.pop((chip, timer), None)
+            self._backend.forget(chip, timer)
+        if self._verbose:
+            self._log('info: resync {}'.format('all' if chip is None else '{} {}'.format(chip, timer)))
+        return True
+
+    def _fade(self, chip, timer, start, end, duration, curve='linear'):
+        if curve not in curves.keys():
+            return 'error: unknown fade curve \'{}\', use one of: {}'.format(
+                curve, ', '.join(curves.keys()))
+        if not self._isopen(chip, timer):
+            return self._log('error: attempt to fade unexported timer {}'.format(
+                self._node(chip, timer)))
+        start = float(max(0, min(1, start)))
+        end = float(max(0, min(1, end)))
+        # replaces any running fade on the timer
+        self._jobs[(chip, timer)] = pwmfade(chip, timer, start, end, duration, curve, perf_counter())
+        self._wake.set()
+        if self._verbose:
+            self._log('info: fade {} {} from {} to {} over {}s ({})'.format(
+                chip, timer, start, end, duration, curve))
+        return True
+
+    def _servomove(self, chip, timer, target, time, profile='trapezoid', settle=0.5):
+        # time is a duration in seconds, or a speed as '<ratio per second>/s'
+        if profile not in profiles.keys():
+            return 'error: unknown servo profile \'{}\', use one of: {}'.format(
+                profile, ', '.join(profiles.keys()))
+        if not self._isopen(chip, timer):
+            return self._log('error: attempt to move unexported timer {}'.format(
+                self._node(chip, timer)))
+        target = float(max(0, min(1, target)))
+        period, end = self._servotarget(target, chip, timer)
+        p = self._assigned.get((chip, timer))
+        smin, smax, sint = (self.smin, self.smax, self.sint) if p is None else (p.smin, p.smax, p.sint)
+        # start from the current pulse width if the servo is enabled, otherwise jump
+        state = self._get(chip, timer)
+        start = end
+        if state is not None and state[0] == 1 and state[1] == period:
+            start = period - state[2] if state[3] == 'inversed' else state[2]
+        try:
+            if time.endswith('/s'):
+                speed = float(time[:-2])
+                span = (smax - smin) * basefreq
+                duration = 0 if speed <= 0 or span == 0 else abs(end - start) / span / speed
+            else:
+                duration = float(time)
+        except ValueError:
+            return 'client error: incorrect servomove time \'{}\''.format(time)
+        count = max(1, ceil(duration / sint))
+        self._jobs[(chip, timer)] = servomove(chip, timer, period, start, end,
+            count, profile, sint, settle, perf_counter())
+        self._wake.set()
+        if self._verbose:
+            self._log('info: servomove {} {} to {} in {} steps ({})'.format(
+                chip, timer, target, count, profile))
+        return True
+
+    def _scheduler(self):
+        # Steps the running jobs when due, sleeps when there are none
+        while self.running:
+            now = perf_counter()
+            for key, job in list(self._jobs.items()):
+                if job.due > now:
+                    continue
+                with self._timerlock(*key):
+                    if self._jobs.get(key) is not job:
+                        continue  # cancelled or replaced
+                    self._jitter.record(perf_counter() - job.due)
+                    try:
+                        if self._profiles is None:
+                            done = job.step(self, now)
+                        else:
+                            done = self._profiledcall(job.step, self, now)
+                    except Exception as e:
+                        self._log('error: scheduler job on {} {} failed :: {}'.format(*key, repr(e)))
+                        done = True
+                    if done:
+                        del self._jobs[key]
+            if not self._jobs:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            due = min(job.due for job in list(self._jobs.values()) or [now])
+            if due > perf_counter():
+                self._wake.wait(due - perf_counter())
+                self._wake.clear()
+
+    def _exporter(self):
+        # Periodically writes the stats as a prometheus text format file
+        while self.running:
+            sleep(self.interval)
+            try:
+                with open(self.metrics + '.tmp', 'w') as out:
+                    out.write(self._prometheus(self._stats()))
+                replace(self.metrics + '.tmp', self.metrics)
+            except OSError as e:
+                self._log('error: cannot write metrics to {} :: {}'.format(self.metrics, repr(e)))
+
+    def _prometheus(self, stats):
+        lines = ['pypwmd_uptime_seconds {}'.format(stats['uptime'])]
+        for counter in ('connections', 'authfail', 'timeouts', 'resets', 'unknown',
+                'logdrops', 'logsuppressed', 'superseded'):
+            lines.append('pypwmd_{}_total {}'.format(counter, stats[counter]))
+        lines.append('pypwmd_active_connections {}'.format(stats['active']))
+        for cmd, c in stats['commands'].items():
+            lines.append('pypwmd_commands_total{{command="{}"}} {}'.format(cmd, c['calls']))
+            lines.append('pypwmd_command_errors_total{{command="{}"}} {}'.format(cmd, c['errors']))
+            for metric, hist, total in (('command', c['time'], c['timesum']),
+                    ('sysfs', c['io'], c['iosum'])):
+                cumulative = 0
+                for bound, n in zip(list(buckets) + ['+Inf'], hist):
+                    cumulative += n
+                    lines.append('pypwmd_{}_seconds_bucket{{command="{}",le="{}"}} {}'.format(
+                        metric, cmd, bound, cumulative))
+                lines.append('pypwmd_{}_seconds_sum{{command="{}"}} {}'.format(metric, cmd, total))
+                lines.append('pypwmd_{}_seconds_count{{command="{}"}} {}'.format(metric, cmd, c['calls']))
+        for metric in ('latency', 'jitter'):
+            h = stats[metric]
+            cumulative = 0
+            for bound, n in zip(list(buckets) + ['+Inf'], h['hist']):
+                cumulative += n
+                lines.append('pypwmd_{}_seconds_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+            lines.append('pypwmd_{}_seconds_sum {}'.format(metric, h['sum']))
+            lines.append('pypwmd_{}_seconds_count {}'.format(metric, h['count']))
+            lines.append('pypwmd_{}_seconds_max {}'.format(metric, h['max']))
+        return '\n'.join(lines) + '\n'
+
+    def _batch(self, cmdline):
+        # Operations are comma separated; opens are done first, then all timer
+        # states are read and the new settings written in a single pass, then
+        # closes. Returns a list of results, one per operation.
+        ops = []
+        results = []
+        for opline in ' '.join(cmdline).split(','):
+            if opline.strip() == '':
+                continue
+            op = self._parse(opline.split())
+            if type(op) == str:
+                results.append(op)
+            elif op[0] not in ('open', 'close', 'pwm', 'servo', 'disable') or (
+                    op[0] == 'pwm' and len(op[1]) != 3):
+                err = 'client error: \'{}\' not allowed in batch'.format(opline.strip())
+                results.append(self._log(err) if self._verbose else err)
+            else:
+                ops.append((len(results), op[0], op[1]))
+                results.append(None)
+        # lock all the timers involved, in order
+        locks = [self._timerlock(*t) for t in sorted(set(tuple(a[:2]) for _, _, a in ops))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            for i, cmd, args in ops:
+                if cmd == 'open':
+                    results[i] = self._open(*args)
+                else:
+                    self._jobs.pop(tuple(args[:2]), None)  # cancel any fade
+            sets = []
+            for i, cmd, args in ops:
+                if cmd == 'pwm':
+                    target = (1, *self._pwmtarget(args[2], args[0], args[1]))
+                elif cmd == 'servo':
+                    target = (1, *self._servotarget(args[2], args[0], args[1]))
+                elif cmd == 'disable':
+                    target = (0, None, None)
+                else:
+                    continue
+                sets.append((i, args[0], args[1], target, self._get(args[0], args[1])))
+            for i, chip, timer, target, state in sets:
+                results[i] = self._set(chip, timer, *target, state)
+            for i, cmd, args in ops:
+                if cmd == 'close':
+                    results[i] = self._close(*args)
+        finally:
+            for lock in locks:
+                lock.release()
+        return results
+
     def server(self):
         # Clean any existing socket on startup (or error)
-        if path.exists(socket):
+        if path.exists(self.sock):
             try:
-                remove(socket)
+                remove(self.sock)
             except Exception as e:
-                print('Socket {} already exists and cannot be removed.'.format(socket))
+                print('Socket {} already exists and cannot be removed.'.format(self.sock))
                 print(e)
                 print('Cannot start, is another instance running?')
                 return
         self._log('info: Starting server: pid: {}, uid: {}, gid: {}'.format(
             getpid(), getuid(), getgid()))
         try:
-            with Listener(self.sock, authkey=auth) as listener:
+            # Authentication is done per connection in the client handler threads
+            with Listener(self.sock) as listener:
                 self._log('info: Listening on: ' + listener.address)
                 # Now loop forever while listening and responding to socket
                 self.running = True  # can be forced false to kill server
+                if self.realtime or self.cpus:
+                    self._realtime()
+                Thread(target=self._scheduler, daemon=True).start()
+                self._log('info: ready, {:.1f}ms after server start'.format(
+                    (perf_counter() - self._begin) * 1000))
+                if self.metrics is not None:
+                    Thread(target=self._exporter, daemon=True).start()
                 try:
                     while self.running:
                         self._listen(listener)
@@ -270,38 +1815,154 @@ class pypwm_server:
         except Exception as e:
             self._log('error: failed to start server:\n{}'.format(e))
 
+    def _realtime(self):
+        # Low jitter mode, called from the listener thread before the scheduler
+        # and client handler threads are started; they inherit the scheduling
+        # policy and cpu affinity. The log and journal writers are left as is.
+        from ctypes import CDLL, get_errno
+        import gc
+        if self.cpus:
+            try:
+                sched_setaffinity(0, self.cpus)
+                self._rtstate['cpus'] = sorted(self.cpus)
+            except (OSError, ValueError) as e:
+                self._log('error: cannot set cpu affinity {} :: {}'.format(self.cpus, repr(e)))
+        if not self.realtime:
+            return
+        try:
+            sched_setscheduler(0, SCHED_FIFO, sched_param(self.realtime))
+            self._rtstate['priority'] = self.realtime
+        except (OSError, ValueError) as e:
+            self._log('error: cannot set realtime priority {} :: {}'.format(self.realtime, repr(e)))
+        # Locked memory is never paged out, so small stacks for new threads
+        stack_size(256 * 1024)
+        if CDLL(None, use_errno=True).mlockall(3) == 0:  # MCL_CURRENT | MCL_FUTURE
+            self._rtstate['mlock'] = True
+        else:
+            self._log('error: cannot lock memory :: {}'.format(strerror(get_errno())))
+        # Preallocate: read (and cache) all the exported timers, opening their files
+        self._states()
+        # Everything allocated so far is kept out of garbage collection, and
+        # collections are much less frequent while running
+        gc.collect()
+        gc.freeze()
+        gc.set_threshold(50000, 20, 100)
+        self._rtstate['gc'] = 'frozen'
+        self._log('info: realtime mode: {}'.format(self._rtstate))
+
     def _listen(self,listener):
+        # Accept connections and hand each one off to a handler thread
         try:
-            with listener.accept() as conn:
-                try:
-                    recieved = conn.recv()
-                except EOFError:
-                    if self._verbose:
-                        self._log('warning: null connection on socket')
-                    return
-                except Exception as e:
-                    if self._verbose:
-                        self._log('warning: recieve failure on socket:\n{}'.format(e))
-                    return
-                cmdline = recieved.strip().split(' ')
-                #self._log('Recieved: {}'.format(cmdline))  # debug
-                conn.send(self._process(cmdline))
+            conn = listener.accept()
+        except Exception as e:
+            return self._log('error: listner failed on socket:\n{}'.format(e))
+        self._count('connections')
+        Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        self._count('active')
+        try:
+            with conn:
+                s = fromfd(conn.fileno(), AF_UNIX, SOCK_STREAM)
+                if self.timeout:
+                    # Kernel enforced recieve timeout, stalled clients are dropped
+                    s.setsockopt(SOL_SOCKET, SO_RCVTIMEO, pack('ll',
+                        int(self.timeout), int(self.timeout % 1 * 1000000)))
+                # the client uid is also needed for privileged commands
+                pid, uid, gid = _ucred.unpack(s.getsockopt(SOL_SOCKET, SO_PEERCRED, _ucred.size))
+                s.close()
+                self._iotime.uid = uid
+                if self.peercred:
+                    # no handshake, the kernel tells us who the client is
+                    if not self._permitted(uid, gid):
+                        self._count('authfail')
+                        self._log('warning: connection refused for pid {} uid {} gid {}'.format(pid, uid, gid))
+                        return conn.send('error: not authorised for uid {}'.format(uid))
+                else:
+                    deliver_challenge(conn, auth)
+                    answer_challenge(conn, auth)
+                # Serve commands until the client closes the connection,
+                # session clients keep it open between commands.
+                served = 0
+                while self.running:
+                    try:
+                        recieved = conn.recv_bytes()
+                    except EOFError:
+                        if served == 0 and self._verbose:
+                            self._log('warning: null connection on socket')
+                        return
+                    except BlockingIOError:
+                        self._count('timeouts')
+                        if self._verbose:
+                            self._log('warning: idle connection timed out')
+                        return
+                    except Exception as e:
+                        if self._verbose:
+                            self._log('warning: recieve failure on socket:\n{}'.format(e))
+                        return
+                    if recieved and recieved[0] == _bmagic:
+                        conn.send(self._binary(recieved))
+                    else:
+                        try:
+                            message = _loads(recieved)
+                        except Exception as e:
+                            self._log('warning: bad request on socket from uid {}: {}'.format(
+                                self._iotime.uid, repr(e)))
+                            return
+                        if type(message) == tuple and type(message[0]) == int:
+                            # pipelined request, the reply carries the request id
+                            reqid, message = message
+                            conn.send((reqid, self._request(message)))
+                        elif type(message) == str and message.split(' ')[0] == 'watch':
+                            return self._watch(conn, message.strip().split(' ')[1:])
+                        else:
+                            #self._log('Recieved: {}'.format(message))  # debug
+                            conn.send(self._request(message))
+                    served += 1
         except AuthenticationError:
+            self._count('authfail')
             if self._verbose:
                 self._log('warning: authentication error on socket')
-        except ConnectionResetError:
+        except BlockingIOError:
+            self._count('timeouts')
+            if self._verbose:
+                self._log('warning: authentication timed out on socket')
+        except (ConnectionResetError, BrokenPipeError):
+            self._count('resets')
             if self._verbose:
                 self._log('warning: connection reset on socket')
         except Exception as e:
-            self._log('error: listner failed on socket:\n{}'.format(e))
-
-    def _process(self, cmdline):
-        # 'command':([possible argument lengths],[arguments that are floats])
-        cmdset = {  'info':([1],[]), 'states':([0],[]),
-                    'open':([2],[]), 'close':([2],[]),
-                    'pwm':([2,3],[2]), 'pwmfreq':([0,1],[0]),
-                    'servo':([3],[2]), 'servoset':([0,2,3],[0,1,2]),
-                    'disable':([2],[]),}
+            self._log('error: client handler failed on socket:\n{}'.format(e))
+        finally:
+            self._count('active', -1)
+
+    def _permitted(self, uid, gid):
+        # peer credential check, supplementary groups are looked up (and cached)
+        if uid == 0 or uid == getuid() or uid in self.uids or gid in self.gids:
+            return True
+        if not self.uids and not self.gids:
+            return True
+        cached = self._allowed.get(uid)
+        if cached is not None and time() - cached[0] < 60:
+            return cached[1]
+        try:
+            groups = getgrouplist(getpwuid(uid).pw_name, gid)
+        except KeyError:
+            groups = []
+        allowed = any(g in self.gids for g in groups)
+        self._allowed[uid] = (time(), allowed)
+        return allowed
+
+    def _timerlock(self, chip, timer):
+        # returns the lock for a timer, creating it on first use
+        lock = self._locks.get((chip, timer))
+        if lock is None:
+            lock = self._locks.setdefault((chip, timer), Lock())
+        return lock
+
+    def _parse(self, cmdline):
+        # returns (command, [arguments]), or an error string
+        cmdset = self._cmdset
         cmd = cmdline[0]
         args = [] if len(cmdline) == 1 else cmdline[1:]
         #print('{}({})'.format(cmd, '' if len(args) == 0 else ', '.join(args)))  # DEBUG
@@ -315,23 +1976,101 @@ class pypwm_server:
             try:
                 if i in cmdset[cmd][1]:
                     args[i] = float(args[i])
+                elif i in cmdset[cmd][2]:
+                    pass
                 else:
                     # wrapping int(float( allows us to specify values as '1e5' etc.
                     args[i] = int(float(args[i]))
             except:
                 err = 'client error: incorrect argument \'{}\' for \'{}\''.format(args[i], cmd)
                 return self._log(err) if self._verbose else err
-        return getattr(self,'_' + cmd)(*args)
+        return cmd, args
+
+    def _request(self, message):
+        # a command line, or (command line, data) for commands with binary data
+        if type(message) == tuple:
+            cmdline = message[0].strip().split(' ')
+            return self._process(cmdline[0], self._execute, cmdline, message[1])
+        cmdline = message.strip().split(' ')
+        return self._process(cmdline[0], self._execute, cmdline)
+
+    def _process(self, cmd, fn, *args):
+        # runs fn(*args) for a command, recording its processing and sysfs I/O times
+        start = self._iotime.start = perf_counter()
+        self._iotime.seconds = 0.0
+        if self._profiles is None:
+            result = fn(*args)
+        else:
+            result = self._profiledcall(fn, *args)
+        stats = self._cmdstats.get(cmd)
+        if stats is None:
+            self._count('unknown')
+            return result
+        elapsed = perf_counter() - start
+        if type(result) == list:  # batch
+            failed = any(_failed(r) for r in result)
+        else:
+            failed = _failed(result)
+        with self._statslock:
+            stats.record(elapsed, self._iotime.seconds, failed)
+        return result
+
+    def _execute(self, cmdline, data=None):
+        if cmdline[0] == 'batch':
+            return self._batch(cmdline[1:])
+        parsed = self._parse(cmdline)
+        if type(parsed) == str:
+            return parsed
+        cmd, args = parsed
+        if data is not None:
+            if cmd != 'sequence' or len(args) != 2:
+                return 'client error: \'{}\' does not take data'.format(' '.join(cmdline))
+            return self._sequence(*args, data=data)
+        return self._run(cmd, args)
+
+    def _run(self, cmd, args):
+        # runs a parsed command
+        if cmd in ('open', 'close', 'pwm', 'servo', 'disable', 'fade', 'servomove') or (
+                cmd in ('resync', 'coalesce') and args):
+            # timer commands are serialized per timer
+            with self._timerlock(args[0], args[1]):
+                slot = self._setpoints.get((args[0], args[1]))
+                if slot is not None and (cmd == 'servo' or (cmd == 'pwm' and len(args) == 3)):
+                    target = (self._servotarget if cmd == 'servo' else self._pwmtarget)(
+                        args[2], args[0], args[1])
+                    return self._setpoint(slot, (1, *target))
+                if cmd in ('close', 'servo', 'disable') or (cmd == 'pwm' and len(args) == 3):
+                    self._jobs.pop((args[0], args[1]), None)  # cancel any fade
+                return self._dispatch[cmd](*args)
+        return self._dispatch[cmd](*args)
+
+    def _binary(self, data):
+        # process a binary protocol request, returns the reply. The arguments
+        # are already typed, so the command is run without parsing
+        try:
+            cmd, args = bunpack(data)
+        except Exception as e:
+            return 'client error: bad binary request :: {}'.format(repr(e))
+        if len(args) not in self._cmdset[cmd][0]:
+            err = 'client error: bad argument count {} for \'{}\''.format(len(args), cmd)
+            return self._log(err) if self._verbose else err
+        return self._process(cmd, self._run, cmd, args)
 
 class pypwm_client:
     '''
         PWM node control client
     '''
 
-    def __init__(self, sock=socket, verify=True, verbose=False):
+    def __init__(self, sock=socket, verify=True, verbose=False, session=False, binary=False,
+            authkey=auth):
         self._sock = sock
+        self._authkey = authkey  # None for servers using peer credentials
         self.verbose = verbose
         self.connected = None
+        self._session = session
+        self._conn = None
+        self._binary = binary
+        self._protocol = None  # binary protocol version, 0 = text, None = unknown
         if verify:
             info = self.info()
             if info is None:
@@ -345,62 +2084,569 @@ class pypwm_client:
             print(msg)
         return msg
 
+    def _exchange(self, conn, cmdline):
+        if type(cmdline) == bytes:
+            conn.send_bytes(cmdline)
+            ret = conn.recv()
+        else:
+            conn.send(cmdline)
+            ret = conn.recv()
+        self.connected = True
+        return ret
+
+    def _command(self, cmd, *args):
+        # send a command, binary encoded if enabled and supported by the server
+        if self._binary and cmd in opcodes:
+            if self._protocol is None:
+                caps = self._send('caps')
+                if caps is None:
+                    return None
+                # older servers return an error string here
+                binary = caps.get('binary', ()) if type(caps) == dict else ()
+                self._protocol = _bversion if _bversion in binary else 0
+            if self._protocol:
+                return self._send(bpack(cmd, args))
+        return self._send(' '.join([cmd] + [str(a) for a in args]))
+
+    def _connection(self):
+        # returns the session connection, (re)connecting as needed
+        if self._conn is None:
+            self._conn = Client(self._sock, authkey=self._authkey)
+        return self._conn
+
     def _send(self, cmdline):
         if not path.exists(self._sock):
             self._print('{}: error: no server at {}'.format(__name__, self._sock))
+            self.disconnect()
             self.connected = False
             return None
         try:
-            with Client(self._sock, authkey=auth) as conn:
-                conn.send(cmdline)
-                ret = conn.recv()
-                self.connected = True
-                return ret
+            if not self._session:
+                with Client(self._sock, authkey=self._authkey) as conn:
+                    return self._exchange(conn, cmdline)
+            try:
+                return self._exchange(self._connection(), cmdline)
+            except (EOFError, OSError):
+                # session dropped (eg. server restarted), reconnect once and retry
+                self.disconnect()
+                return self._exchange(self._connection(), cmdline)
         except AuthenticationError as e:
             self._print('{}: error: authentication failed: {}'
                 .format(__name__, e))
         except Exception as e:
             self._print('{}: error: socket communications failed: {}\n{}'
                 .format(__name__, self._sock, e))
+        self.disconnect()
         self.connected = False
         return None
 
+    def disconnect(self):
+        # close the session connection, if any. Reopened on next command.
+        self._protocol = None  # renegotiate, the server may have changed
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
     def info(self):
-        return self._send('info {}'.format(getpid()))
+        return self._command('info', getpid())
 
     def states(self):
-        states = self._send('states')
+        states = self._command('states')
         return states
 
     def open(self, chip, timer):
-        return self._send('open {} {}'.format(chip, timer))
+        return self._command('open', chip, timer)
 
     def close(self, chip, timer):
-        return self._send('close {} {}'.format(chip, timer))
+        return self._command('close', chip, timer)
 
     def pwm(self, chip, timer, ratio = None):
-        return self._send('pwm {} {} {}'.format(chip, timer, '' if ratio is None else ratio))
+        if ratio is None:
+            return self._command('pwm', chip, timer)
+        return self._command('pwm', chip, timer, ratio)
 
     def pwmfreq(self, freq = None):
-        return self._send('pwmfreq {}'.format('' if freq is None else freq))
+        if freq is None:
+            return self._command('pwmfreq')
+        return self._command('pwmfreq', freq)
 
     def servo(self, chip, timer, ratio):
-        return self._send('servo {} {} {}'.format(chip, timer, ratio))
+        return self._command('servo', chip, timer, ratio)
+
+    def servomove(self, chip, timer, target, duration=None, speed=None,
+            profile='trapezoid', settle=0.5):
+        # give either a duration (seconds) or a speed (full range per second)
+        time = '{}/s'.format(speed) if duration is None else duration
+        return self._command('servomove', chip, timer, target, time, profile, settle)
 
     def servoset(self, minpulse=None, maxpulse=None, interval = None):
-        cur = self._send('servoset')
+        cur = self._command('servoset')
         if minpulse is None and maxpulse is None and interval is None:
             return cur
         minpulse = cur[0] if minpulse is None else minpulse
         maxpulse = cur[1] if maxpulse is None else maxpulse
         interval = cur[2] if interval is None else interval
-        return self._send('servoset {} {} {}'.format(minpulse, maxpulse, interval))
+        return self._command('servoset', minpulse, maxpulse, interval)
 
     def disable(self, chip, timer):
-        return self._send('disable {} {}'.format(chip, timer))
+        return self._command('disable', chip, timer)
+
+    def fade(self, chip, timer, start, end, duration, curve='linear'):
+        return self._command('fade', chip, timer, start, end, duration, curve)
+
+    def cachestats(self):
+        return self._command('cachestats')
+
+    def stats(self):
+        return self._command('stats')
+
+    def profile(self, seconds, top=20):
+        # blocks for 'seconds' while the server is profiled
+        return self._command('profile', seconds, top)
+
+    def preset(self, name=None, pwmfreq=None, polarity='normal', minpulse=None,
+            maxpulse=None, interval=None):
+        if name is None or pwmfreq is None:
+            return self._command('preset', *[a for a in (name,) if a is not None])
+        if minpulse is None or maxpulse is None:
+            return self._command('preset', name, pwmfreq, polarity)
+        if interval is None:
+            return self._command('preset', name, pwmfreq, polarity, minpulse, maxpulse)
+        return self._command('preset', name, pwmfreq, polarity, minpulse, maxpulse, interval)
+
+    def assign(self, chip, timer, name=None):
+        if name is None:
+            return self._command('assign', chip, timer)
+        return self._command('assign', chip, timer, name)
+
+    def sequence(self, name=None, samples=None, rate=None):
+        # samples are pwm ratios, an array('f') or any list of numbers.
+        # With no samples returns the stored sequence(s), or removes one if rate is 0
+        if samples is None:
+            if rate is not None:
+                return self._command('sequence', name, rate)
+            return self._command('sequence', *[a for a in (name,) if a is not None])
+        if type(samples) != array or samples.typecode != 'f':
+            samples = array('f', samples)
+        return self._send(('sequence {} {}'.format(name, rate), samples.tobytes()))
+
+    def play(self, name, timers, loops=1):
+        # timers is a list of (chip, timer) started together, loops 0 = forever
+        return self._command('play', name, loops, *[a for t in timers for a in t])
+
+    def coalesce(self, chip=None, timer=None, period=None):
+        if chip is None:
+            return self._command('coalesce')
+        if period is None:
+            return self._command('coalesce', chip, timer)
+        return self._command('coalesce', chip, timer, period)
+
+    def rescan(self):
+        return self._command('rescan')
+
+    def resync(self, chip=None, timer=None):
+        if chip is None:
+            return self._command('resync')
+        return self._command('resync', chip, timer)
+
+    def watch(self, chip=None, timer=None):
+        # generator, yields (chip, timer, state) for the current states and then
+        # for every change. state is None for closed timers. Uses a dedicated
+        # connection, stop by closing the generator (or leaving the loop).
+        cmdline = ' '.join(['watch'] + [str(a) for a in (chip, timer) if a is not None])
+        try:
+            with Client(self._sock, authkey=self._authkey) as conn:
+                conn.send(cmdline)
+                while True:
+                    events = conn.recv()
+                    if type(events) == str:
+                        self._print(events)
+                        return
+                    yield from events
+        except AuthenticationError as e:
+            self._print('{}: error: authentication failed: {}'.format(__name__, e))
+        except (EOFError, OSError) as e:
+            self._print('{}: error: watch connection failed: {}\n{}'
+                .format(__name__, self._sock, e))
 
+    def batch(self, ops):
+        # ops is a list of (command, chip, timer[, ratio]) tuples
+        return self._send('batch ' + ' , '.join(' '.join(str(a) for a in op) for op in ops))
 
-if __name__ == "__main__":
+class pypwm_aclient:
+    '''
+        asyncio PWM node control client
+        Keeps one connection open, requests are pipelined; many can be in
+        flight at once and replies are matched to them by request id.
+    '''
+
+    def __init__(self, sock=socket, verbose=False, maxinflight=256, authkey=auth):
+        self._sock = sock
+        self._authkey = authkey  # None for servers using peer credentials
+        self.verbose = verbose
+        self.connected = None
+        self._conn = None
+        self._loop = None
+        self._pending = {}  # request id: future
+        self._ids = count()
+        self._maxinflight = maxinflight
+        self._slots = None  # limits requests in flight, created in the event loop
+        self._connecting = None
+
+    def _print(self, msg):
+        if self.verbose:
+            print(msg)
+        return msg
+
+    def _open(self):
+        # blocking connect, authenticate and check the server can pipeline
+        conn = Client(self._sock, authkey=self._authkey)
+        conn.send('caps')
+        caps = conn.recv()
+        if type(caps) != dict or not caps.get('pipeline', False):
+            conn.close()
+            raise ConnectionError('server does not support pipelined requests')
+        return conn
+
+    async def connect(self):
+        # asyncio is imported here, it is slow to load and not needed otherwise
+        import asyncio
+        if self._conn is not None:
+            return True
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+            self._slots = asyncio.Semaphore(self._maxinflight)
+        async with self._connecting:
+            if self._conn is not None:
+                return True
+            if not path.exists(self._sock):
+                self._print('{}: error: no server at {}'.format(__name__, self._sock))
+                self.connected = False
+                return False
+            self._loop = asyncio.get_running_loop()
+            try:
+                # the handshake is blocking, run it outside the event loop (once)
+                conn = await self._loop.run_in_executor(None, self._open)
+            except AuthenticationError as e:
+                self._print('{}: error: authentication failed: {}'.format(__name__, e))
+                self.connected = False
+                return False
+            except Exception as e:
+                self._print('{}: error: socket communications failed: {}\n{}'
+                    .format(__name__, self._sock, e))
+                self.connected = False
+                return False
+            self._conn = conn
+            self._loop.add_reader(conn.fileno(), self._read)
+            self.connected = True
+            return True
+
+    def _read(self):
+        # called by the event loop when replies are waiting
+        try:
+            while self._conn is not None and self._conn.poll():
+                reqid, result = self._conn.recv()
+                future = self._pending.pop(reqid, None)
+                if future is not None and not future.done():
+                    future.set_result(result)
+        except (EOFError, OSError) as e:
+            self._drop(e)
+
+    def _drop(self, e):
+        # connection lost, requests in flight fail and the next one reconnects
+        if self._conn is not None:
+            self._loop.remove_reader(self._conn.fileno())
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+        self.connected = False
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection to {} lost: {}'
+                    .format(self._sock, e)))
+
+    def disconnect(self):
+        self._drop('disconnected')
+
+    async def _command(self, cmd, *args, data=None):
+        if not await self.connect():
+            return None
+        async with self._slots:
+            if self._conn is None:  # dropped while waiting for a slot
+                if not await self.connect():
+                    return None
+            reqid = next(self._ids)
+            message = ' '.join([cmd] + [str(a) for a in args])
+            message = (reqid, message if data is None else (message, data))
+            try:
+                self._conn.send(message)
+            except OSError as e:
+                # stale connection (eg. server restarted), reconnect once and retry
+                self._drop(e)
+                if not await self.connect():
+                    return None
+                try:
+                    self._conn.send(message)
+                except OSError as e:
+                    self._drop(e)
+                    self._print('{}: error: socket communications failed: {}\n{}'
+                        .format(__name__, self._sock, e))
+                    return None
+            future = self._loop.create_future()
+            self._pending[reqid] = future
+            try:
+                return await future
+            except ConnectionError as e:
+                self._print('{}: error: {}'.format(__name__, e))
+                return None
+            finally:
+                # also cleans up after cancellation, a late reply is ignored
+                self._pending.pop(reqid, None)
+
+    async def info(self):
+        return await self._command('info', getpid())
+
+    async def states(self):
+        return await self._command('states')
+
+    async def open(self, chip, timer):
+        return await self._command('open', chip, timer)
+
+    async def close(self, chip, timer):
+        return await self._command('close', chip, timer)
+
+    async def pwm(self, chip, timer, ratio = None):
+        if ratio is None:
+            return await self._command('pwm', chip, timer)
+        return await self._command('pwm', chip, timer, ratio)
+
+    async def pwmfreq(self, freq = None):
+        if freq is None:
+            return await self._command('pwmfreq')
+        return await self._command('pwmfreq', freq)
+
+    async def servo(self, chip, timer, ratio):
+        return await self._command('servo', chip, timer, ratio)
+
+    async def servomove(self, chip, timer, target, duration=None, speed=None,
+            profile='trapezoid', settle=0.5):
+        time = '{}/s'.format(speed) if duration is None else duration
+        return await self._command('servomove', chip, timer, target, time, profile, settle)
+
+    async def servoset(self, minpulse=None, maxpulse=None, interval = None):
+        cur = await self._command('servoset')
+        if minpulse is None and maxpulse is None and interval is None:
+            return cur
+        minpulse = cur[0] if minpulse is None else minpulse
+        maxpulse = cur[1] if maxpulse is None else maxpulse
+        interval = cur[2] if interval is None else interval
+        return await self._command('servoset', minpulse, maxpulse, interval)
+
+    async def disable(self, chip, timer):
+        return await self._command('disable', chip, timer)
+
+    async def fade(self, chip, timer, start, end, duration, curve='linear'):
+        return await self._command('fade', chip, timer, start, end, duration, curve)
+
+    async def stats(self):
+        return await self._command('stats')
+
+    async def profile(self, seconds, top=20):
+        return await self._command('profile', seconds, top)
+
+    async def preset(self, name=None, pwmfreq=None, polarity='normal', minpulse=None,
+            maxpulse=None, interval=None):
+        if name is None or pwmfreq is None:
+            return await self._command('preset', *[a for a in (name,) if a is not None])
+        if minpulse is None or maxpulse is None:
+            return await self._command('preset', name, pwmfreq, polarity)
+        if interval is None:
+            return await self._command('preset', name, pwmfreq, polarity, minpulse, maxpulse)
+        return await self._command('preset', name, pwmfreq, polarity, minpulse, maxpulse, interval)
+
+    async def assign(self, chip, timer, name=None):
+        if name is None:
+            return await self._command('assign', chip, timer)
+        return await self._command('assign', chip, timer, name)
+
+    async def sequence(self, name=None, samples=None, rate=None):
+        if samples is None:
+            if rate is not None:
+                return await self._command('sequence', name, rate)
+            return await self._command('sequence', *[a for a in (name,) if a is not None])
+        if type(samples) != array or samples.typecode != 'f':
+            samples = array('f', samples)
+        return await self._command('sequence', name, rate, data=samples.tobytes())
+
+    async def play(self, name, timers, loops=1):
+        return await self._command('play', name, loops, *[a for t in timers for a in t])
+
+    async def coalesce(self, chip=None, timer=None, period=None):
+        if chip is None:
+            return await self._command('coalesce')
+        if period is None:
+            return await self._command('coalesce', chip, timer)
+        return await self._command('coalesce', chip, timer, period)
+
+    async def batch(self, ops):
+        return await self._command('batch', ' , '.join(' '.join(str(a) for a in op) for op in ops))
+
+class pypwm_cluster:
+    '''
+        PWM node control client for many servers
+        Timers are addressed as (node, chip, timer), nodes are named in a
+        {name: socket} map. One persistent connection is kept per node and
+        commands for several nodes are sent in parallel. Each node has to
+        connect and answer within 'timeout' seconds, failed nodes return an
+        error string.
+    '''
+
+    def __init__(self, nodes, timeout=2, verbose=False, authkey=auth):
+        # imported here, only needed for clusters
+        from concurrent.futures import ThreadPoolExecutor
+        self.nodes = dict(nodes)
+        self.timeout = timeout
+        self.verbose = verbose
+        self._authkey = authkey
+        self._pool = {}  # node: connection
+        self._locks = {node: Lock() for node in self.nodes.keys()}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.nodes)))
+
+    def _print(self, msg):
+        if self.verbose:
+            print(msg)
+        return msg
+
+    def _drop(self, node):
+        conn = self._pool.pop(node, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _connect(self, node):
+        # like Client(), but a stopped or stuck node cannot block the connect
+        # and handshake for longer than the timeout
+        s = sockobj(AF_UNIX, SOCK_STREAM)
+        timeval = pack('ll', int(self.timeout), int(self.timeout % 1 * 1000000))
+        s.setsockopt(SOL_SOCKET, SO_RCVTIMEO, timeval)
+        s.setsockopt(SOL_SOCKET, SO_SNDTIMEO, timeval)
+        try:
+            s.connect(self.nodes[node])
+        except OSError:
+            s.close()
+            raise
+        conn = Connection(s.detach())
+        try:
+            if self._authkey is not None:
+                answer_challenge(conn, self._authkey)
+                deliver_challenge(conn, self._authkey)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _exchange(self, node, cmdline):
+        conn = self._pool.get(node)
+        if conn is None:
+            conn = self._pool[node] = self._connect(node)
+        conn.send(cmdline)
+        if not conn.poll(self.timeout):
+            # a late reply would be read as the next one, start afresh
+            self._drop(node)
+            raise TimeoutError('no reply in {}s'.format(self.timeout))
+        return conn.recv()
+
+    def _send(self, node, cmdline):
+        # one request to a node, the pooled connection is reopened once if stale
+        if node not in self.nodes:
+            return self._print('error: unknown node \'{}\''.format(node))
+        with self._locks[node]:
+            try:
+                try:
+                    return self._exchange(node, cmdline)
+                except (EOFError, BrokenPipeError, ConnectionResetError):
+                    self._drop(node)
+                    return self._exchange(node, cmdline)
+            except Exception as e:
+                self._drop(node)
+                return self._print('error: node {} ({}) failed: {}'.format(
+                    node, self.nodes[node], repr(e)))
+
+    def _fanout(self, requests):
+        # {node: command line} -> {node: reply}, all nodes in parallel
+        futures = {node: self._executor.submit(self._send, node, cmdline)
+            for node, cmdline in requests.items()}
+        return {node: future.result() for node, future in futures.items()}
+
+    def _command(self, node, cmd, *args):
+        return self._send(node, ' '.join([cmd] + [str(a) for a in args]))
+
+    def broadcast(self, cmd, *args):
+        # send a command to every node, returns {node: reply}
+        cmdline = ' '.join([cmd] + [str(a) for a in args])
+        return self._fanout({node: cmdline for node in self.nodes.keys()})
+
+    def failed(self, replies):
+        # the nodes in a {node: reply} result that failed
+        return [node for node, reply in replies.items() if _failed(reply)]
+
+    def disconnect(self):
+        for node in list(self._pool.keys()):
+            with self._locks[node]:
+                self._drop(node)
+
+    def info(self):
+        return self.broadcast('info', getpid())
+
+    def states(self):
+        return self.broadcast('states')
+
+    def open(self, node, chip, timer):
+        return self._command(node, 'open', chip, timer)
+
+    def close(self, node, chip, timer):
+        return self._command(node, 'close', chip, timer)
+
+    def pwm(self, node, chip, timer, ratio = None):
+        if ratio is None:
+            return self._command(node, 'pwm', chip, timer)
+        return self._command(node, 'pwm', chip, timer, ratio)
+
+    def servo(self, node, chip, timer, ratio):
+        return self._command(node, 'servo', chip, timer, ratio)
+
+    def disable(self, node, chip, timer):
+        return self._command(node, 'disable', chip, timer)
+
+    def fade(self, node, chip, timer, start, end, duration, curve='linear'):
+        return self._command(node, 'fade', chip, timer, start, end, duration, curve)
+
+    def batch(self, ops):
+        # ops is a list of (command, node, chip, timer[, ratio]) tuples, sent as
+        # one batch per node, in parallel. Returns a list of results, one per op.
+        bynode = {}
+        for i, (cmd, node, *args) in enumerate(ops):
+            bynode.setdefault(node, []).append((i, ' '.join(str(a) for a in [cmd] + args)))
+        replies = self._fanout({node: 'batch ' + ' , '.join(op for _, op in nodeops)
+            for node, nodeops in bynode.items()})
+        results = [None] * len(ops)
+        for node, nodeops in bynode.items():
+            reply = replies[node]
+            for n, (i, _) in enumerate(nodeops):
+                # a failed node fails all of its operations
+                results[i] = reply[n] if type(reply) == list and n < len(reply) else reply
+        return results
+
+
+def main():
     '''
         Commandline Client
     '''
@@ -408,15 +2654,35 @@ if __name__ == "__main__":
     usage = '''Usage: v{0}
     {1} command <options>
     where 'command' is one of:
-        server [<logfile>] [--verbose]
+        server [<logfile>] [--verbose] [--timeout=<seconds>] [--tick=<seconds>]
+               [--metrics=<file>] [--logsize=<bytes>] [--logage=<seconds>]
+               [--peercred [--uids=<user>,..] [--gids=<group>,..]]
+               [--journal=<file>] [--backend=sysfs|chardev|sim]
+               [--realtime[=<priority>]] [--cpus=<cpu>,..]
         states
         open <chip> <timer>
         close <chip> <timer>
         pwm <chip> <timer> [<pwm-ratio>]
         pwmfreq [<frequency>]
+        fade <chip> <timer> <from> <to> <duration> [<curve>]
         servo <chip> <timer> <servo-ratio>
+        servomove <chip> <timer> <servo-ratio> <time> [<profile> [<settle>]]
         servoset [<min-period> <max-period> [<interval>]]
+        preset [<name> [<frequency> [<polarity> [<min-period> <max-period> [<interval>]]]]]
+        assign <chip> <timer> [<name>]
         disable <chip> <timer>
+        coalesce [<chip> <timer> [<period>]]
+        sequence [<name> [0]]
+        play <name> <loops> <chip> <timer> [<chip> <timer> ...]
+        batch <operation> [, <operation> ...]
+        watch [<chip> [<timer>]]
+        stream [<file>] [--pipeline] [--exit-on-error]
+        resync [<chip> <timer>]
+        rescan
+        cachestats
+        stats
+        profile <seconds> [<top>]
+        caps
         info
 
     <chip> and <timer> are integers.
@@ -426,8 +2692,43 @@ if __name__ == "__main__":
     - needs to run as root, see the main documentation for more.
     - an optional logfile or log directory can be supplied and
       adding the option '--verbose' enables extended logging.
+    - the logfile is rotated when it reaches '--logsize' (default 1000000
+      bytes, 0 = never) or is '--logage' seconds old (default 0 = never),
+      3 old logfiles are kept. SIGHUP makes the server reopen the logfile.
+    - log messages are written in the background, if the server is logging
+      faster than they can be written messages are dropped and counted (see
+      'stats'). Repeated warnings are limited to 10 per minute each.
+    - clients are served concurrently, '--timeout' sets how long an idle
+      client connection is kept open (default 60 seconds, 0 = forever).
+    - '--tick' sets the step interval for fades (default 0.01 seconds).
+    - '--peercred' authorises clients by their user and group ids, as seen
+      by the kernel, instead of the (shared) socket authkey. This needs no
+      handshake, so is faster, but clients must also use '--peercred'.
+      root, the server user, and the users and groups (names or numbers) in
+      '--uids' and '--gids' are allowed; with no lists everyone with access
+      to the socket file is allowed.
+    - '--metrics' writes the 'stats' to a file every 10 seconds in the
+      prometheus text format (eg. for the node_exporter textfile collector).
+    - '--journal' keeps the pwmfreq, servoset, preset, assign and coalesce
+      settings, the exported timers and their last settings in a file (or
+      'pyPWMd.journal' in a directory), and restores them when the server
+      starts. Timers are only written where they differ from the journal,
+      timers that are still enabled are left as they are. After a reboot
+      enabled timers are not restored, so outputs do not change at boot. Changes are written once a second. Sequences are not
+      kept.
+    - '--backend' selects how the timers are driven; 'sysfs' (default) uses
+      the /sys/class/pwm tree, 'chardev' uses the pwm character devices
+      (/dev/pwmchip<n>, Linux 6.13 and later), which set the period, duty
+      cycle and enable of a timer in one call instead of up to four sysfs
+      writes. 'sim' simulates a chip with 8 timers in memory, for testing.
+    - '--realtime' runs the server with SCHED_FIFO scheduling at <priority>
+      (1-99, default 50), locks its memory and freezes the garbage collector
+      once started, for smoother fades and servo moves on a busy system.
+      '--cpus' pins the server to a list of cpus, eg. an isolated core.
+      Compare the 'latency' and 'jitter' in 'stats' with and without.
 
     All other commands are sent to the server.
+    - add '--peercred' if the server is using peer credential authorisation.
 
     'states' lists the available pwm chips, timers, and their status.
     - If a node entry is unexported it is shown as 'None'.
@@ -450,9 +2751,24 @@ if __name__ == "__main__":
     - Default is 1000 (1KHz).
     - If called with no argument it returns the current setting.
 
+    'fade' fades the timer from one pwm ratio to another over a duration.
+    - The fade is run by the server, the command returns immediately.
+    - <curve> is one of 'linear' (default), 'gamma' (perceived brightness,
+      for LEDs) or 'ease' (eases in and out).
+    - Any other command that sets the timer cancels a running fade.
+
     'servo' enables and sets the timer to output servo pulses.
     - The position is a float between 0 (min) and 1 (max) positions.
 
+    'servomove' moves the servo to a position following a motion profile.
+    - <time> is the duration of the move in seconds, or a speed given as
+      '<ratio per second>/s', eg '0.5/s' takes 2 seconds for a full swing.
+    - <profile> is 'trapezoid' (default, constant acceleration) or 'scurve'.
+    - The move is run by the server, stepping at the servo interval, and the
+      timer is disabled <settle> seconds after the move ends (default 0.5,
+      a negative value leaves the servo enabled).
+    - Any other command that sets the timer cancels a running move.
+
     'servoset' shows or sets the servo timings and interval.
     - The first two arguments are the minimum and maximum pulse width
       times for the servo in seconds (floats).
@@ -463,19 +2779,125 @@ if __name__ == "__main__":
       hobby servo motors. Check datasheets and test for your motors as needed.
     - If called with no argument it returns the current timings in seconds.
 
+    'preset' defines a named set of pwm and servo settings that can be
+      assigned to timers, so timers can use different settings at once.
+    - <frequency> is the pwm frequency in Hz, <polarity> is 'normal' (default)
+      or 'inversed' to invert the output ratio. The servo settings are as for
+      'servoset' and default to the current servo settings.
+    - Redefining a preset updates the timers using it, a <frequency> of 0
+      removes the preset.
+    - Periods and duty conversions are precomputed, and a timer keeps its
+      period, so updates to a timer only write the duty_cycle.
+    - With just a name returns that preset, with no arguments returns all
+      presets and the timers they are assigned to.
+
+    'assign' makes a timer use a preset for its 'pwm', 'servo', 'fade' and
+      'servomove' commands instead of the 'pwmfreq' and 'servoset' defaults.
+    - With no <name> the timer goes back to using the defaults.
+
     'disable' immediately disables the timer.
     - This should be used as needed with the servo commands to stop the servo
       after it has moved to position to avoid hunting and jittering.
     - The kernel pwm api does not specify the output when disabled, typically
       it defaults to high-impedance but you should test this.
 
+    'coalesce' turns on write coalescing for a timer, for streaming setpoints
+      (eg. from a joystick or control loop) faster than the output can follow.
+    - 'pwm' and 'servo' settings for the timer are then applied at most once
+      per <period> seconds (default is the servo interval), only the latest
+      setting is applied and any it replaced are counted as superseded.
+    - A setting is applied immediately if the period has passed since the
+      last one, otherwise at the end of the period.
+    - A <period> of 0 turns coalescing off for the timer.
+    - With no arguments returns the coalescing timers, as
+      {{'<chip> <timer>': {{'period': <s>, 'applied': <n>, 'superseded': <n>}}}}
+
+    'sequence' lists the stored sequences, shows one, or removes it (0).
+    - Sequences are pwm ratio waveforms played back by the server, they are
+      uploaded from Python with pypwm_client.sequence(), as packed floats.
+    - Returns {{<name>: {{'samples': <n>, 'rate': <per second>, 'duration': <s>}}}}
+
+    'play' plays a stored sequence on one or more timers, starting together.
+    - Samples are played at the sequence rate, <loops> times (0 = forever),
+      the timers are left at the last sample.
+    - Any other command that sets a timer stops the sequence on it.
+
+    'batch' applies a comma separated list of operations in one request.
+    - Operations are any of the open, close, pwm, servo and disable
+      commands above, eg: 'batch pwm 0 0 0.5 , servo 0 1 0.2 , disable 0 2'
+    - Timers are opened first, then all timer settings are applied in a
+      single pass to minimise the skew between timers, then closed.
+    - Returns a list with the result of each operation.
+
+    'watch' prints timer states as they change, until interrupted.
+    - The current state of each timer is printed first, then each change as
+      (<chip>, <timer>, <state>), state is as for 'states'.
+    - Only changes made through the server are seen, not changes made to
+      the /sys/class/pwm tree by other processes.
+    - Optionally limited to a chip, or a single timer.
+
+    'stream' (or '-') reads commands, one per line, from stdin or a file
+      (or fifo) and sends them over a single connection to the server,
+      printing one reply per line. Empty lines and '#' comments are skipped.
+    - '--pipeline' sends commands without waiting for each reply, replies
+      are printed in the same order as the commands.
+    - '--exit-on-error' stops at the first command that fails.
+    - Exits with 1 if any command failed.
+
+    'resync' makes the server re-read timer states from the /sys/class/pwm
+      tree, for all timers or the specified timer.
+    - The server keeps a copy of the state of each timer it has accessed and
+      only reads the tree on first access or after an error. Use this if
+      timers are also being changed by other processes.
+
+    'rescan' makes the server rescan the /sys/class/pwm tree for pwm chips.
+    - The server keeps an index of chips and timers. It is updated when the
+      modification time of the tree changes, but sysfs does not reliably
+      update this; use 'rescan' after adding or removing pwm chips.
+    - Timers opened or closed by other processes are seen by 'states'.
+    - Returns a dict of {{<chip>: (<path>, <timers>)}}.
+
+    'cachestats' returns the server's timer state cache counters.
+      {{'hits': <count>, 'misses': <count>, 'timers': <cached timers>}}
+
+    'stats' returns the server's metrics.
+    - Connection counts; 'connections', 'active', 'authfail', 'timeouts',
+      'resets' and 'unknown' (unknown commands), log message 'logdrops' and
+      'logsuppressed' (rate limited) counts, coalesced settings 'superseded'
+      and the server 'uptime'.
+    - For each command that has been used; 'calls' and 'errors' counts, and
+      histograms of the processing time ('time') and the time spent reading
+      and writing the /sys/class/pwm tree ('io'), plus their totals
+      ('timesum', 'iosum') in seconds.
+    - 'latency' is the time from receiving a command to the timer being
+      written, 'jitter' is how late the scheduler runs fade, move, sequence
+      and coalescing steps. Both as {{'count', 'sum', 'max', 'hist'}}.
+    - 'realtime' shows the realtime settings in use, if any.
+    - Histogram buckets are counts of times up to the matching 'buckets'
+      entry (seconds), the last bucket counts anything longer.
+
+    'profile' profiles (with cProfile) the commands and scheduler jobs the
+      server runs in the next <seconds>, then returns the <top> (default 20)
+      functions by their own time:
+      {{'file': <stats file>, 'seconds': <s>, 'threads': <n>, 'calls': <n>,
+       'time': <s>, 'top': [(<own s>, <total s>, <calls>, '<function>'), ..]}}
+    - 'own' is time in the function itself, 'total' includes the functions
+      it called. 'time' is the total profiled time.
+    - The stats are written next to the logfile (or the socket), view them
+      with 'python3 -m pstats <file>'.
+    - Only for root and the server user. When not profiling there is no
+      profiler overhead, and commands already running are not profiled.
+
+    'caps' returns the server capabilities.
+      {{'binary': (<supported binary protocol versions>), 'pipeline': True}}
+
     'info' returns a tuple with server details.
       ('version', pid, uid, gid, '<syspath>')
 
     Homepage: https://github.com/easytarget/pyPWMd
     '''.format(version, name, socket).strip()
 
-    def runserver(logfile, verbose):
+    def runserver(logfile, verbose, timeout, tick, **config):
         '''
           Init and run a server,
         '''
@@ -489,9 +2911,19 @@ if __name__ == "__main__":
         if logfile is not None:
             if path.isdir(logfile):
                 logfile += '/pyPWMd.log'
+        if config.get('journal') is not None and path.isdir(config['journal']):
+            config['journal'] += '/pyPWMd.journal'
         print('Starting Python PWM server v{}'.format(version))
-        p = pypwm_server(logfile, verbose)
+        try:
+            p = pypwm_server(logfile, verbose, timeout, tick, **config)
+        except KeyError as e:
+            print('{}: unknown user or group: {}'.format(name, e))
+            exit(2)
         atexit.register(cleanup,p)
+        signal(SIGHUP, lambda signum, frame: p.reopenlog())
+        # exit cleanly on SIGTERM (systemctl stop/restart), so the atexit
+        # handlers run and the journal is flushed
+        signal(SIGTERM, lambda signum, frame: exit(0))
         p.server()
 
     def runcommand(cmdline):
@@ -501,33 +2933,94 @@ if __name__ == "__main__":
         if not path.exists(socket):
             return('error: no pwm server at \'{}\''.format(socket), 1)
         try:
-            with Client(socket, authkey=auth) as conn:
+            with Client(socket, authkey=authkey) as conn:
                 conn.send(' '.join(cmdline))
                 reply = conn.recv()
         except AuthenticationError as e:
             reply = 'error: authentication failed: {}'.format(e)
         except Exception as e:
             reply = 'error: socket communications failed:\n{}'.format(e)
-        if reply is None:
-            state = 1
-        elif type(reply) == str and 'error' in reply.lower():
-            state = 1
+        if type(reply) == list:  # batch
+            state = 1 if any(_failed(r) for r in reply) else 0
         else:
-            state = 0
+            state = 1 if _failed(reply) else 0
         return reply, state
 
+    def runstream(source, pipeline, errexit):
+        '''
+          Send commands, one per line, from a file (or fifo) or stdin over a
+          single connection and print one reply per line
+        '''
+        if not path.exists(socket):
+            print('error: no pwm server at \'{}\''.format(socket))
+            return 1
+        def commands(lines):
+            for line in lines:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    yield line
+        def failed(reply):
+            return any(_failed(r) for r in reply) if type(reply) == list else _failed(reply)
+        status = 0
+        try:
+            with (stdin if source in (None, '-') else open(source)) as lines, \
+                    Client(socket, authkey=authkey) as conn:
+                if not pipeline:
+                    for line in commands(lines):
+                        if line.split(' ')[0] == 'watch':
+                            reply = 'client error: \'watch\' is not available in a stream'
+                        else:
+                            conn.send(line)
+                            reply = conn.recv()
+                        print(reply, flush=True)
+                        if failed(reply):
+                            status = 1
+                            if errexit:
+                                break
+                    return status
+                # Pipelined, commands are sent without waiting for the replies
+                # (up to 256 ahead), the replies come back in the same order.
+                window = Semaphore(256)
+                sent = Queue()
+                def sender():
+                    try:
+                        for reqid, line in enumerate(commands(lines)):
+                            window.acquire()
+                            conn.send((reqid, line))
+                            sent.put(reqid)
+                    except (OSError, ValueError):
+                        pass
+                    sent.put(None)
+                Thread(target=sender, daemon=True).start()
+                for _ in iter(sent.get, None):
+                    reqid, reply = conn.recv()
+                    window.release()
+                    print(reply, flush=True)
+                    if failed(reply):
+                        status = 1
+                        if errexit:
+                            break
+        except AuthenticationError as e:
+            print('error: authentication failed: {}'.format(e))
+            return 1
+        except (EOFError, OSError) as e:
+            print('error: socket communications failed:\n{}'.format(e))
+            return 1
+        return status
+
     # Parse Arguments and take appropriate action
     if len(argv) == 1:
         print('{}: No command specified, try: {} help'.format(name, argv[0]))
         exit(2)
 
-    try:
-        l = argv.index('--verbose')
-    except ValueError:
-        logall = False
-    else:
-        logall = True
-        argv.pop(l)
+    # Options are given as '--option' or '--option=value'
+    options = {}
+    for arg in [a for a in argv[2:] if a.startswith('--')]:
+        argv.remove(arg)
+        option, _, value = arg[2:].partition('=')
+        options[option] = value
+    logall = 'verbose' in options
+    authkey = None if 'peercred' in options else auth
 
     # Command is always first argument
     command = argv[1]
@@ -537,10 +3030,50 @@ if __name__ == "__main__":
         print(usage)
     elif command == 'server':
         logfile = None if len(argv) < 3 else argv[2]
-        runserver(logfile, logall)
+        try:
+            timeout = float(options.get('timeout', 60))
+            tick = float(options.get('tick', 0.01))
+            logsize = int(options.get('logsize', 1000000))
+            logage = float(options.get('logage', 0))
+            # users and groups may be given by name or number
+            uids, gids = [[int(i) if i.isdigit() else i for i in options[o].split(',')]
+                if options.get(o) else [] for o in ('uids', 'gids')]
+            backend = backends[options.get('backend', 'sysfs')]()
+            realtime = int(options['realtime'] or 50) if 'realtime' in options else 0
+            cpus = [int(c) for c in options['cpus'].split(',')] if options.get('cpus') else []
+        except ValueError:
+            print('{}: invalid option value'.format(name))
+            exit(2)
+        except KeyError as e:
+            print('{}: unknown backend: {}'.format(name, e))
+            exit(2)
+        runserver(logfile, logall, timeout, tick, metrics=options.get('metrics', None),
+            logsize=logsize, logage=logage, peercred='peercred' in options,
+            uids=uids, gids=gids, journal=options.get('journal', None), backend=backend,
+            realtime=realtime, cpus=cpus)
+    elif command in ('stream', '-'):
+        try:
+            exit(runstream(None if len(argv) < 3 else argv[2],
+                'pipeline' in options, 'exit-on-error' in options))
+        except KeyboardInterrupt:
+            exit(130)
+    elif command == 'watch':
+        client = pypwm_client(verify=False, verbose=True, authkey=authkey)
+        try:
+            for event in client.watch(*[int(a) for a in argv[2:4]]):
+                print(event, flush=True)
+        except KeyboardInterrupt:
+            exit(0)
+        except ValueError:
+            print('{}: <chip> and <timer> must be integers'.format(name))
+            exit(2)
+        exit(1)  # the watch only ends on errors
     else:
         response, status = runcommand(argv[1:])
         if response != True:
             print(response)
         exit(status)
     exit(0)
+
+if __name__ == "__main__":
+    main()